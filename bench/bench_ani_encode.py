@@ -0,0 +1,54 @@
+"""
+ナウキャストのアニメーションの出力形式ごとのエンコード時間とサイズ
+
+    python bench/bench_ani_encode.py [半径(m)] [ズーム]
+
+`NOWCAST_RAIN_LAT`, `NOWCAST_RAIN_LON`がある場合は実際のデータ、ない場合は合成したフレームを使う
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from PIL import Image, ImageDraw
+
+from jma_nowcast import ani_formats, encode_ani
+from jma_nowcast.jma_nowcast import get_nowc_forecast_images, level_by_color, rain_composite
+
+def synthetic_frames(size:int, n_frames:int=13) -> list[Image.Image]:
+    # 背景地図の代わりに淡いノイズ、降水の代わりに移動する色付きの円
+    rnd = random.Random(0)
+    base = Image.effect_noise((size, size), 12).convert('RGBA')
+    colors = [_c for _c in level_by_color if _c[3] > 0]
+    blobs = [(rnd.randrange(size), rnd.randrange(size), rnd.randrange(size//16+1, size//4+2), rnd.choice(colors)) for _ in range(12)]
+    frames = []
+    for _i in range(n_frames):
+        rain = Image.new('RGBA', (size, size))
+        draw = ImageDraw.Draw(rain)
+        for x, y, r, color in blobs:
+            x += _i * size // 64
+            draw.ellipse((x-r, y-r, x+r, y+r), fill=color)
+        frames.append(rain_composite(base, rain))
+    return frames
+
+def main():
+    radius = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    zoom = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    if 'NOWCAST_RAIN_LAT' in os.environ and 'NOWCAST_RAIN_LON' in os.environ:
+        imgs = get_nowc_forecast_images(float(os.environ['NOWCAST_RAIN_LAT']), float(os.environ['NOWCAST_RAIN_LON']), radius, zoom)
+        source = 'live'
+    else:
+        imgs = synthetic_frames(2 * int(radius / (156543.03392 * 0.82 / 2 ** zoom)))
+        source = 'synthetic'
+    print(f'{source}: {len(imgs)} frames {imgs[0].width}x{imgs[0].height}')
+    print(f'{"format":8} {"encode(ms)":>10} {"bytes":>10}')
+    for fmt in ani_formats:
+        start = time.perf_counter()
+        data = encode_ani(imgs, fmt)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f'{fmt:8} {elapsed:10.1f} {len(data):10d}')
+
+if __name__ == '__main__':
+    main()
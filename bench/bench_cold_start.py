@@ -0,0 +1,58 @@
+"""
+モジュールごとのimport時間(新しいプロセスで計測)と、読み込まれた重い依存
+
+    python bench/bench_cold_start.py [モジュール ...]
+
+`COLD_START_BUDGET_MS`(既定300)を超えたモジュールがあれば終了コード1
+"""
+import os
+import re
+import subprocess
+import sys
+
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+default_modules = ['jma_common', 'jma_amedas', 'jma_forecast', 'jma_vpfd', 'jma_bunpu', 'jma_nowcast', 'amedas_mqtt']
+heavy_modules = ['requests', 'aiohttp', 'PIL', 'numpy', 'paho']
+budget_ms = float(os.environ.get('COLD_START_BUDGET_MS', '300'))
+
+_importtime_line = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+def measure(module: str) -> tuple[float|None, list[str], str]:
+    """
+    (累積のimport時間(ms), 読み込まれた重い依存, エラー)
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=src_dir, capture_output=True, text=True,
+    )
+    total = None
+    loaded = set()
+    for line in proc.stderr.splitlines():
+        m = _importtime_line.match(line)
+        if not m:
+            continue
+        name = m.group(4)
+        if name.split('.')[0] in heavy_modules:
+            loaded.add(name.split('.')[0])
+        if name == module:
+            total = int(m.group(2)) / 1000
+    if proc.returncode != 0:
+        return None, sorted(loaded), proc.stderr.strip().splitlines()[-1]
+    return total, sorted(loaded), ''
+
+def main():
+    modules = sys.argv[1:] or default_modules
+    over = False
+    print(f'{"module":14} {"import(ms)":>10}  heavy deps')
+    for module in modules:
+        total, loaded, error = measure(module)
+        if total is None:
+            print(f'{module:14} {"-":>10}  {error}')
+            continue
+        mark = ' over budget' if total > budget_ms else ''
+        over = over or bool(mark)
+        print(f'{module:14} {total:10.1f}  {",".join(loaded) or "-"}{mark}')
+    sys.exit(1 if over else 0)
+
+if __name__ == '__main__':
+    main()
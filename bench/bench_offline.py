@@ -0,0 +1,147 @@
+"""
+記録したデータを使う、ネットワークなしのベンチマーク
+
+    python bench/bench_offline.py --record                     # 実際のURLから記録する(一度だけ)
+    python bench/bench_offline.py [--iterations N] [対象 ...]   # 記録したデータで計測する
+
+記録先は`JMA_BENCH_CORPUS`(既定は`bench/corpus`)
+
+ローカルサーバ(`jma_standin.py`)を別プロセスで起動し、`JMA_ORIGIN_OVERRIDE`でリクエストを向ける
+ディスクキャッシュとタイルの保存は使わない。メモリキャッシュは実際の常駐と同じく残す
+対象ごとに初回(cold)と2回目以降の待ち時間の分位点、1秒あたりの回数、1回のメモリ確保のピークを出力する
+
+地点は`NOWCAST_RAIN_LAT`, `NOWCAST_RAIN_LON`, `JMA_AREA_CD_CLASS20`, `JMA_AMEDAS_POINT_CD`(省略時は東京、最寄りの地点)
+記録したデータは記録した時刻のものなので、同じ記録を使った計測どうしで比べること
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from jma_standin import create_server, default_corpus_dir
+
+default_targets = ['amedas', 'forecast', 'vpfd', 'nowcast', 'bunpu', 'nowcast_images']
+
+def _serve(corpus_dir:str, record:bool, ports:multiprocessing.Queue):
+    server = create_server(corpus_dir, record)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+def start_standin(corpus_dir:str, record:bool) -> tuple[multiprocessing.Process, str]:
+    """
+    start stand-in server in another process, returns (process, origin)
+    """
+    ports = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_serve, args=(corpus_dir, record, ports), daemon=True)
+    proc.start()
+    return proc, f'http://127.0.0.1:{ports.get(timeout=10)}'
+
+def build_targets(out_dir:str) -> dict:
+    """
+    benchmark targets, resolving site codes (this also fetches area.json, amedastable and bunpu maps)
+    """
+    from jma_common import get_area_cd_class10_by_class15, get_area_cd_class15_by_class20
+    from jma_amedas import get_amedas_latest_time, get_amedas_point_data_latest, get_amedas_points_nearest
+    from jma_forecast import get_forecast_data_pretty
+    from jma_vpfd import get_vpfd_data_pretty
+    from jma_nowcast import get_nowc_forecast, load_and_save_nowc_forecast_images
+    from jma_bunpu import get_bunpu_area_coordinates, get_bunpu_weather
+
+    lat = float(os.environ.get('NOWCAST_RAIN_LAT', '35.69'))
+    lon = float(os.environ.get('NOWCAST_RAIN_LON', '139.75'))
+    radius = int(os.environ.get('NOWCAST_RAIN_RADIUS', '10000'))
+    area_cd_class10 = get_area_cd_class10_by_class15(get_area_cd_class15_by_class20(os.environ.get('JMA_AREA_CD_CLASS20', '1310100')))
+    amedas_point_cd = os.environ.get('JMA_AMEDAS_POINT_CD') or get_amedas_points_nearest(lat, lon, 1, ['temp', 'sun'])[0]['cd']
+    bunpu_tile = get_bunpu_area_coordinates(lat, lon)
+    return {
+        'amedas': lambda: get_amedas_point_data_latest(amedas_point_cd),
+        'forecast': lambda: get_forecast_data_pretty(area_cd_class10),
+        'vpfd': lambda: get_vpfd_data_pretty(area_cd_class10),
+        'nowcast': lambda: get_nowc_forecast(lat, lon),
+        'bunpu': lambda: get_bunpu_weather(*bunpu_tile, get_amedas_latest_time()),
+        'nowcast_images': lambda: load_and_save_nowc_forecast_images(os.path.join(out_dir, 'nowc_rain.png'), lat, lon, radius),
+    }
+
+def percentile(sorted_values:list[float], p:float) -> float:
+    # nearest-rank
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+def measure(func, iterations:int) -> dict:
+    """
+    cold latency, latencies of following calls, peak allocation of one call
+    """
+    start = time.perf_counter()
+    func()
+    cold = time.perf_counter() - start
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    # tracemallocは計測を遅くするので、時間とは別に1回だけ
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'cold': cold,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1],
+        'throughput': len(latencies) / sum(latencies),
+        'peak_alloc': peak,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--record', action='store_true')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('targets', nargs='*', help=f'{", ".join(default_targets)} (default: all)')
+    args = parser.parse_args()
+    unknown = [_t for _t in args.targets if _t not in default_targets]
+    if unknown:
+        parser.error(f'unknown targets: {", ".join(unknown)}')
+    corpus_dir = os.environ.get('JMA_BENCH_CORPUS', default_corpus_dir)
+    record, iterations = args.record, args.iterations
+
+    proc, origin = start_standin(corpus_dir, record)
+    # 取得したデータの再利用はメモリだけにして、毎回同じ条件にする
+    os.environ['JMA_ORIGIN_OVERRIDE'] = origin
+    os.environ.pop('JMA_CACHE_DIR', None)
+    os.environ.pop('NOWCAST_TILE_STORE', None)
+    try:
+        with tempfile.TemporaryDirectory() as out_dir:
+            try:
+                targets = build_targets(out_dir)
+            except Exception as e:
+                sys.exit(f'cannot resolve site from {corpus_dir} ({e!r}), record it first with --record')
+            if record:
+                for name in default_targets:
+                    targets[name]()
+                n_files = sum(len(_files) for _, _, _files in os.walk(corpus_dir))
+                print(f'recorded {n_files} files in {corpus_dir}')
+                return
+            print(f'{"target":15} {"cold(ms)":>9} {"p50(ms)":>9} {"p90(ms)":>9} {"p99(ms)":>9} {"max(ms)":>9} {"calls/s":>8} {"peak(KB)":>9}')
+            for name in args.targets or default_targets:
+                try:
+                    result = measure(targets[name], iterations)
+                except Exception as e: # 記録にないURLなど
+                    print(f'{name:15} error: {e!r}')
+                    continue
+                print(f'{name:15}' + ''.join(f' {result[_k] * 1000:9.1f}' for _k in ['cold', 'p50', 'p90', 'p99', 'max'])
+                      + f' {result["throughput"]:8.1f} {result["peak_alloc"] / 1024:9.0f}')
+            print(f'max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB, {iterations} iterations')
+    finally:
+        proc.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+気象庁(と地理院タイル)の代わりに、記録したデータを返すローカルサーバ
+
+    python bench/jma_standin.py [記録先ディレクトリ] [--record] [--port ポート]
+
+`JMA_ORIGIN_OVERRIDE=http://127.0.0.1:ポート` を指定すると、`https://{host}{path}` へのリクエストが
+`http://127.0.0.1:ポート/{host}{path}` に向き、`{記録先}/{host}{path}` のファイルを返す(無ければ404)
+`--record` では、無いファイルを本来のURLから取得して保存する
+"""
+import http.server
+import mimetypes
+import os
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+default_corpus_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+def corpus_path(corpus_dir:str, path:str) -> str|None:
+    """
+    file path for request path `/{host}{path}?{query}`, None if outside corpus
+    """
+    parts = urllib.parse.urlsplit(path)
+    rel = urllib.parse.unquote(parts.path).lstrip('/')
+    if parts.query:
+        rel += '@' + urllib.parse.quote(parts.query, safe='')
+    full = os.path.realpath(os.path.join(corpus_dir, rel))
+    if not full.startswith(os.path.realpath(corpus_dir) + os.sep):
+        return None
+    return full
+
+class _standin_handler(http.server.BaseHTTPRequestHandler):
+    """
+    request handler serving corpus files, internal use only
+    """
+    corpus_dir = default_corpus_dir
+    record = False
+    lock = threading.Lock()
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def respond(self, with_body:bool):
+        path = corpus_path(self.corpus_dir, self.path)
+        if path is None:
+            self.send_error(400)
+            return
+        if not os.path.isfile(path) and self.record:
+            status = self.fetch_upstream(path)
+            if status != 200:
+                self.send_error(status)
+                return
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as bodyf:
+            body = bodyf.read()
+        self.send_response(200)
+        self.send_header('Content-Type', mimetypes.guess_type(self.path.split('?')[0])[0] or 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def fetch_upstream(self, path:str) -> int:
+        """
+        fetch original URL and store it to `path`, returns status
+        """
+        url = 'https://' + self.path.lstrip('/')
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers={'User-Agent': 'jma-standin-recorder'}), timeout=30) as resp:
+                body = resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code
+        except urllib.error.URLError:
+            return 502
+        with self.lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as bodyf:
+                bodyf.write(body)
+        return 200
+
+    def log_message(self, format, *args):
+        pass
+
+def create_server(corpus_dir:str=default_corpus_dir, record:bool=False, port:int=0) -> http.server.ThreadingHTTPServer:
+    """
+    create stand-in server on localhost, port 0 picks a free port
+    """
+    handler = type('standin_handler', (_standin_handler,), {'corpus_dir': corpus_dir, 'record': record})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+def main():
+    args = [_a for _a in sys.argv[1:] if not _a.startswith('--')]
+    port = int(sys.argv[sys.argv.index('--port') + 1]) if '--port' in sys.argv else 8765
+    if '--port' in sys.argv:
+        args.remove(str(port))
+    server = create_server(args[0] if args else default_corpus_dir, '--record' in sys.argv, port)
+    print(f'JMA_ORIGIN_OVERRIDE=http://127.0.0.1:{server.server_address[1]}')
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
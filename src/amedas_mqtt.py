@@ -1,43 +1,44 @@
 import datetime
+import hashlib
 import json
+import logging
 import os
+import signal
+import sys
+import threading
+import time
 
 import paho.mqtt.client as mqtt
 from paho.mqtt.enums import CallbackAPIVersion
 
-from pprint import pprint
-
-from jma_common import parse_dt_str, get_area_cd_office_by_class10,get_area_cd_class10_by_class15,get_area_cd_class15_by_class20,get_sunny_or_clear_night
-from jma_amedas import get_amedas_latest_time, get_amedas_point_data_latest, amedas_data_flatten
+from jma_common import fetch_cycle, fetch_stats, setup_logging, metrics, parse_dt_str, format_dt_str, get_area_cd_office_by_class10,get_area_cd_class10_by_class15,get_area_cd_class15_by_class20,get_sunny_or_clear_night
+from jma_amedas import get_amedas_latest_time, get_amedas_point_data_latest, get_amedas_points_data_latest, get_amedas_points_nearest, amedas_data_flatten
 from jma_vpfd import get_vpfd_data_pretty
 from jma_forecast import get_forecast_data_pretty
 from jma_nowcast import get_nowc_forecast
-from jma_bunpu import get_bunpu_area_coordinates,get_bunpu_weather
-
-mqtt_broker = os.environ.get('MQTT_BROKER')
-mqtt_port = int(os.environ.get('MQTT_PORT','1883'))
-mqtt_username = os.environ.get('MQTT_USERNAME')
-mqtt_password = os.environ.get('MQTT_PASSWORD')
-mqtt_topic_amedas_stat = os.environ.get('MQTT_TOPIC_AMEDAS_STAT')
-mqtt_topic_amedas_attr = os.environ.get('MQTT_TOPIC_AMEDAS_ATTR')
-mqtt_topic_amedas_avty = os.environ.get('MQTT_TOPIC_AMEDAS_AVTY')
-
-map_lat=float(os.environ['NOWCAST_RAIN_LAT'])
-map_lon=float(os.environ['NOWCAST_RAIN_LON'])
-
-amedas_point_cd = os.environ.get('JMA_AMEDAS_POINT_CD')
-
-area_cd_class20 = os.environ.get('JMA_AREA_CD_CLASS20')
-area_cd_class15 = get_area_cd_class15_by_class20(area_cd_class20)
-area_cd_class10 = get_area_cd_class10_by_class15(area_cd_class15)
-area_cd_office = get_area_cd_office_by_class10(area_cd_class10)
+from jma_bunpu import get_bunpu_area_coordinates,get_bunpu_weather_frame
 
-amedas_data = amedas_data_flatten(get_amedas_point_data_latest(amedas_point_cd))
+logger = logging.getLogger('amedas_mqtt')
 
-bunpu_tile_cd, bunpu_tile_pxl_x, bunpu_tile_pxl_y = get_bunpu_area_coordinates(map_lat,map_lon)
-
-amedas_latest_time = get_amedas_latest_time()
-bunpu_weather = get_bunpu_weather(bunpu_tile_cd, bunpu_tile_pxl_x, bunpu_tile_pxl_y, amedas_latest_time)
+# 常駐モードでの各データの更新間隔(秒)
+refresh_intervals = {
+    'amedas': 10 * 60,
+    'bunpu': 10 * 60,
+    'nowcast': 5 * 60,
+    'vpfd': 60 * 60,
+    'forecast': 60 * 60,
+}
+# 取得に失敗した場合の再試行までの間隔(秒)
+retry_interval = 60
+# 単発実行で接続(onlineの送信)を待つ時間(秒)
+connect_timeout = 30
+# 内容が同じでも、この間隔(秒)を過ぎたら再送する(retainが失われた場合の保険)
+republish_interval = int(os.environ.get('MQTT_REPUBLISH_INTERVAL', str(60 * 60)))
+# 指定した場合、属性のうち大きなセクションをサブトピック({attr}/{section})に分けて、変化したものだけ送る
+publish_sections = os.environ.get('MQTT_PUBLISH_SECTIONS', '').lower() in ['1', 'true', 'yes']
+attr_sections = ['forecast_hourly', 'forecast_daily']
+# 指定した場合、アメダスを地点ごとのファイルではなく全地点のデータから取得する(多地点向け)
+amedas_bulk = os.environ.get('JMA_AMEDAS_BULK', '').lower() in ['1', 'true', 'yes']
 
 def convert_vpdf_weather(w: str, dtstr: str|None = None)-> str:
     match w:
@@ -51,7 +52,7 @@ def convert_vpdf_weather(w: str, dtstr: str|None = None)-> str:
             return 'snowy-rainy'
         case '雪':
             return 'snowy'
-        
+
 def convert_vpdf_direction(d: str)-> int:
     match d:
         case '北':
@@ -71,12 +72,6 @@ def convert_vpdf_direction(d: str)-> int:
         case '北西':
             return 315
 
-# ナウキャスト降水情報
-nowc_forecast = get_nowc_forecast(map_lat,map_lon)
-# 現在及び5分後に降水なしならクリア、それ以外は雨
-nowc_weather = 'clear' if nowc_forecast[0][2]==0 and nowc_forecast[1][2]==0 else 'rainy'
-pprint(nowc_forecast)
-
 def get_overall_weather(amedas_data:any, nowc_weather:str, bunpu_weather:str, dt:datetime):
     """
     アメダス、ナウキャスト降水情報、推計気象分布から判断した現在の天気
@@ -103,56 +98,407 @@ def get_overall_weather(amedas_data:any, nowc_weather:str, bunpu_weather:str, dt
     # (ナウキャストがクリアで推計気象分布が降水なしで)アメダスで日照がなければ推計気象分布に従う
     return bunpu_weather
 
-overall_weather = get_overall_weather(amedas_data, nowc_weather, bunpu_weather, amedas_latest_time)
-
-vpfd=get_vpfd_data_pretty(area_cd_class10)
-fcst=get_forecast_data_pretty(area_cd_class10)
-fcst_h=[
-    {
-        'datetime': _x['datetime'],
-        'condition':convert_vpdf_weather(_x['weather'], _x['datetime']),
-        'temperature':_x['temperature'],
-        'templow':_x['minTemperature'],
-        'wind_speed':_x['wind_speed'],
-        'wind_gust_speed':_x['gust_speed_high'],
-        'wind_bearing':convert_vpdf_direction(_x['wind_direction']),
-    } for _x in vpfd
-]
-fcst_d=[
-    {
-        'datetime': _t,
-        'condition':_x['weather_hass'],
-        'temperature':_x['temp_max'],
-        'templow':_x['temp_min'],
-    } for _t,_x in fcst.items() if parse_dt_str(_t) > datetime.datetime.now().astimezone(datetime.timezone.utc)
-]
-# アメダスの風向を角度に変換。16は風が弱くて特定できていない状態
-amedas_data['windDirection'] = float(amedas_data['windDirection'] * 22.5) if amedas_data['windDirection']<16 else None
-amedas_data['gustDirection'] = float(amedas_data['gustDirection'] * 22.5) if amedas_data['gustDirection']<16 else None
-amedas_data['nowc_weather'] = nowc_weather
-amedas_data['bunpu_weather'] = bunpu_weather
-amedas_data['overall_weather'] = overall_weather
-amedas_data['forecast_hourly'] = fcst_h
-amedas_data['forecast_daily'] = fcst_d
-for _i, _x in enumerate(nowc_forecast):
-    amedas_data[f'nowc_rain_{_i*5:02d}']=_x[2]
-
-pprint(amedas_data)
-
-mqtt_cli = mqtt.Client(CallbackAPIVersion.VERSION2)
-if (mqtt_username) or (mqtt_password):
-    mqtt_cli.username_pw_set(mqtt_username, mqtt_password) 
-mqtt_cli.connect(mqtt_broker, mqtt_port, 60)
-mqtt_cli.loop_start()
-
-pub1 = mqtt_cli.publish(mqtt_topic_amedas_stat, overall_weather, qos=1, retain=True)
-pub2 = mqtt_cli.publish(mqtt_topic_amedas_attr, json.dumps(amedas_data), qos=1, retain=True)
-pub3 = mqtt_cli.publish(mqtt_topic_amedas_avty, 'online', qos=1, retain=True)
-
-#送信完了までプログラムを落とさないように待つ
-pub1.wait_for_publish()
-pub2.wait_for_publish()
-pub3.wait_for_publish()
-
-mqtt_cli.disconnect()
-mqtt_cli.loop_stop()
+def load_mqtt_config() -> dict:
+    """
+    MQTTブローカーの設定を環境変数から読み込む
+    """
+    return {
+        'broker': os.environ.get('MQTT_BROKER'),
+        'port': int(os.environ.get('MQTT_PORT','1883')),
+        'username': os.environ.get('MQTT_USERNAME'),
+        'password': os.environ.get('MQTT_PASSWORD'),
+        # 複数地点の場合のブリッジ全体の可用性トピック
+        'topic_avty': os.environ.get('MQTT_TOPIC_BRIDGE_AVTY'),
+        # 指定した場合、サイクルごとに取得と処理のメトリクスをJSONで送る
+        'topic_metrics': os.environ.get('MQTT_TOPIC_METRICS'),
+    }
+
+def load_site() -> dict:
+    """
+    地点の設定を環境変数から読み込む
+    """
+    return {
+        'amedas_point_cd': os.environ.get('JMA_AMEDAS_POINT_CD'),
+        'area_cd_class20': os.environ.get('JMA_AREA_CD_CLASS20'),
+        'lat': float(os.environ['NOWCAST_RAIN_LAT']),
+        'lon': float(os.environ['NOWCAST_RAIN_LON']),
+        'topic_stat': os.environ.get('MQTT_TOPIC_AMEDAS_STAT'),
+        'topic_attr': os.environ.get('MQTT_TOPIC_AMEDAS_ATTR'),
+        'topic_avty': os.environ.get('MQTT_TOPIC_AMEDAS_AVTY'),
+    }
+
+def load_sites() -> list[dict]:
+    """
+    地点の一覧を読み込む
+
+    `AMEDAS_MQTT_SITES`にJSONファイルを指定した場合はその一覧(各要素は`load_site`と同じキー)、
+    指定しない場合は環境変数の1地点
+    """
+    sites_path = os.environ.get('AMEDAS_MQTT_SITES')
+    if not sites_path:
+        return [load_site()]
+    with open(sites_path, 'rt', encoding='utf-8') as sitesf:
+        sites = json.load(sitesf)
+    return [{**_site, 'lat': float(_site['lat']), 'lon': float(_site['lon'])} for _site in sites]
+
+def resolve_site(site: dict) -> dict:
+    """
+    地点の設定から、更新のたびに求める必要のない地域コードと推計気象分布の座標を求める
+    """
+    area_cd_class15 = get_area_cd_class15_by_class20(site['area_cd_class20'])
+    area_cd_class10 = get_area_cd_class10_by_class15(area_cd_class15)
+    bunpu_tile_cd, bunpu_tile_pxl_x, bunpu_tile_pxl_y = get_bunpu_area_coordinates(site['lat'],site['lon'])
+    amedas_point_cd = site.get('amedas_point_cd')
+    if not amedas_point_cd:
+        # 未指定の場合は、現在の天気の判定に使う気温と日照のある最寄りの地点
+        amedas_point_cd = get_amedas_points_nearest(site['lat'], site['lon'], 1, ['temp', 'sun'])[0]['cd']
+    return {
+        **site,
+        'amedas_point_cd': amedas_point_cd,
+        'area_cd_class15': area_cd_class15,
+        'area_cd_class10': area_cd_class10,
+        'area_cd_office': get_area_cd_office_by_class10(area_cd_class10),
+        'bunpu_tile': (bunpu_tile_cd, bunpu_tile_pxl_x, bunpu_tile_pxl_y),
+    }
+
+class _amedas_snapshot:
+    """
+    AMeDAS data of all configured sites fetched once per cycle (bulk mode), internal use only
+    """
+    def __init__(self):
+        self.point_cds = []
+        self.latest_time = None
+        self.points = None
+
+    def reset(self, sites: list[dict]):
+        """
+        start new cycle, data is fetched on first `get`
+        """
+        self.point_cds = list(dict.fromkeys(_site['amedas_point_cd'] for _site in sites))
+        self.latest_time = None
+        self.points = None
+
+    def get(self, amedas_point_cd: str) -> tuple[datetime.datetime, dict]:
+        """
+        (latest time, point data)
+        """
+        if self.points is None:
+            self.latest_time = get_amedas_latest_time()
+            self.points = get_amedas_points_data_latest(self.point_cds, self.latest_time)
+        return self.latest_time, self.points[amedas_point_cd]
+
+amedas_snapshot = _amedas_snapshot()
+
+def refresh_amedas(site: dict, data: dict):
+    if amedas_bulk:
+        # 全地点のデータはサイクルごとに一度だけ全地点分を取り出し、地点ごとに分ける
+        data['amedas_latest_time'], amedas_point_data = amedas_snapshot.get(site['amedas_point_cd'])
+    else:
+        amedas_point_data = get_amedas_point_data_latest(site['amedas_point_cd'])
+        data['amedas_latest_time'] = get_amedas_latest_time()
+    data['amedas'] = amedas_data_flatten(amedas_point_data)
+
+def refresh_bunpu(site: dict, data: dict):
+    bunpu = get_bunpu_weather_frame(*site['bunpu_tile'], data['amedas_latest_time'])
+    data['bunpu_weather'] = bunpu['weather']
+    data['bunpu_time'] = bunpu['time']
+
+def refresh_nowcast(site: dict, data: dict):
+    # ナウキャスト降水情報
+    data['nowc_forecast'] = get_nowc_forecast(site['lat'],site['lon'])
+    logger.debug('nowcast %s %s', site['topic_stat'], data['nowc_forecast'])
+
+def refresh_vpfd(site: dict, data: dict):
+    data['vpfd'] = get_vpfd_data_pretty(site['area_cd_class10'])
+
+def refresh_forecast(site: dict, data: dict):
+    data['forecast'] = get_forecast_data_pretty(site['area_cd_class10'])
+
+# 取得順に並べる(bunpuはamedasの最新時刻を使う)
+refresh_funcs = {
+    'amedas': refresh_amedas,
+    'bunpu': refresh_bunpu,
+    'nowcast': refresh_nowcast,
+    'vpfd': refresh_vpfd,
+    'forecast': refresh_forecast,
+}
+
+def build_payload(data: dict) -> tuple[str, dict]:
+    """
+    取得したデータから状態(天気)と属性を作る
+    """
+    nowc_forecast = data['nowc_forecast']
+    # 現在及び5分後に降水なしならクリア、それ以外は雨
+    nowc_weather = 'clear' if nowc_forecast[0][2]==0 and nowc_forecast[1][2]==0 else 'rainy'
+    bunpu_weather = data['bunpu_weather']
+    amedas_data = dict(data['amedas'])
+    overall_weather = get_overall_weather(amedas_data, nowc_weather, bunpu_weather, data['amedas_latest_time'])
+
+    fcst_h=[
+        {
+            'datetime': _x['datetime'],
+            'condition':convert_vpdf_weather(_x['weather'], _x['datetime']),
+            'temperature':_x['temperature'],
+            'templow':_x['minTemperature'],
+            'wind_speed':_x['wind_speed'],
+            'wind_gust_speed':_x['gust_speed_high'],
+            'wind_bearing':convert_vpdf_direction(_x['wind_direction']),
+        } for _x in data['vpfd']
+    ]
+    fcst_d=[
+        {
+            'datetime': _t,
+            'condition':_x['weather_hass'],
+            'temperature':_x['temp_max'],
+            'templow':_x['temp_min'],
+        } for _t,_x in data['forecast'].items() if parse_dt_str(_t) > datetime.datetime.now().astimezone(datetime.timezone.utc)
+    ]
+    # アメダスの風向を角度に変換。16は風が弱くて特定できていない状態
+    amedas_data['windDirection'] = float(amedas_data['windDirection'] * 22.5) if amedas_data['windDirection']<16 else None
+    amedas_data['gustDirection'] = float(amedas_data['gustDirection'] * 22.5) if amedas_data['gustDirection']<16 else None
+    amedas_data['nowc_weather'] = nowc_weather
+    amedas_data['bunpu_weather'] = bunpu_weather
+    # 推計気象分布は1時間ごとで遅れて公開されるため、どの時刻の画像かを示す
+    amedas_data['bunpu_time'] = format_dt_str(data['bunpu_time']) if data['bunpu_time'] else None
+    amedas_data['overall_weather'] = overall_weather
+    amedas_data['forecast_hourly'] = fcst_h
+    amedas_data['forecast_daily'] = fcst_d
+    for _i, _x in enumerate(nowc_forecast):
+        amedas_data[f'nowc_rain_{_i*5:02d}']=_x[2]
+    return overall_weather, amedas_data
+
+def connect_mqtt(mqtt_config: dict, sites: list[dict]) -> mqtt.Client:
+    """
+    ブローカーに接続する。異常切断時はLWTでofflineにする
+
+    LWTは1接続に1つなので、ブリッジ全体の可用性トピック(既定は可用性トピックのある先頭の地点のもの)に設定する
+    onlineは接続(再接続を含む)のたびにここでだけ送る。送信を待つ場合はuserdataの`online_pubs`を使う
+    """
+    def on_connect(client, userdata, flags, reason_code, properties):
+        # 再接続時にもonlineに戻す。送信の待ちに使うのは最新の接続の分だけ
+        if not reason_code.is_failure:
+            userdata['online_pubs'] = [client.publish(_topic, 'online', qos=1, retain=True) for _topic in availability_topics(mqtt_config, sites)]
+            userdata['connected'].set()
+
+    mqtt_cli = mqtt.Client(CallbackAPIVersion.VERSION2, userdata={'connected': threading.Event(), 'online_pubs': []})
+    if (mqtt_config['username']) or (mqtt_config['password']):
+        mqtt_cli.username_pw_set(mqtt_config['username'], mqtt_config['password'])
+    topics = availability_topics(mqtt_config, sites)
+    if topics:
+        mqtt_cli.will_set(topics[0], 'offline', qos=1, retain=True)
+    mqtt_cli.on_connect = on_connect
+    mqtt_cli.connect(mqtt_config['broker'], mqtt_config['port'], 60)
+    mqtt_cli.loop_start()
+    return mqtt_cli
+
+def availability_topics(mqtt_config: dict, sites: list[dict]) -> list[str]:
+    """
+    ブリッジ全体と各地点の可用性トピック。指定のない地点は含めない
+    """
+    topics = [mqtt_config['topic_avty']] if mqtt_config['topic_avty'] else []
+    for site in sites:
+        topic = site.get('topic_avty')
+        if topic and topic not in topics:
+            topics.append(topic)
+    return topics
+
+class _change_publisher:
+    """
+    publisher suppressing identical payloads per topic
+
+    送信した内容のハッシュをトピックごとに覚え、前回と同じなら送らない
+    `JMA_CACHE_DIR`がある場合はハッシュを保存し、単発実行の間でも引き継ぐ
+    """
+    def __init__(self, mqtt_cli: mqtt.Client, store_path: str|None = None):
+        self.mqtt_cli = mqtt_cli
+        self.store_path = store_path
+        self.fingerprints = dict() # topic -> (digest, published)
+        self.published = 0
+        self.suppressed = 0
+        if store_path:
+            try:
+                with open(store_path, 'rt', encoding='utf-8') as storef:
+                    self.fingerprints = {_k: tuple(_v) for _k, _v in json.load(storef).items()}
+            except (OSError, ValueError):
+                pass
+
+    def publish(self, topic: str, payload: str):
+        """
+        publish retained payload if changed, None if suppressed
+        """
+        digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+        prev = self.fingerprints.get(topic)
+        if prev and prev[0] == digest and time.time() - prev[1] < republish_interval:
+            self.suppressed += 1
+            return None
+        info = self.mqtt_cli.publish(topic, payload, qos=1, retain=True)
+        self.published += 1
+        self.fingerprints[topic] = (digest, time.time())
+        return info
+
+    def save(self):
+        if not self.store_path:
+            return
+        os.makedirs(os.path.dirname(self.store_path), exist_ok=True)
+        with open(self.store_path, 'wt', encoding='utf-8') as storef:
+            json.dump(self.fingerprints, storef)
+
+def create_publisher(mqtt_cli: mqtt.Client) -> _change_publisher:
+    cache_dir = os.environ.get('JMA_CACHE_DIR')
+    return _change_publisher(mqtt_cli, os.path.join(cache_dir, 'mqtt_fingerprints.json') if cache_dir else None)
+
+def publish(publisher: _change_publisher, site: dict, state: str, attr: dict) -> list:
+    logger.debug('attr %s %s', site['topic_attr'], attr)
+    payloads = [(site['topic_stat'], state)]
+    if publish_sections:
+        payloads.append((site['topic_attr'], json.dumps({_k: _v for _k, _v in attr.items() if _k not in attr_sections})))
+        payloads.extend((f"{site['topic_attr']}/{_k}", json.dumps(attr[_k])) for _k in attr_sections)
+    else:
+        payloads.append((site['topic_attr'], json.dumps(attr)))
+    pubs = [publisher.publish(_topic, _payload) for _topic, _payload in payloads]
+    return [_pub for _pub in pubs if _pub is not None]
+
+class _cycle_summary:
+    """
+    counters of one cycle, logged as one line
+
+    取得の件数は`fetch_stats`、送信の件数は`_change_publisher`の累計との差分
+    """
+    fetch_keys = ['requests', 'not_modified', 'disk_hits', 'cycle_hits', 'errors']
+
+    def __init__(self, sites: int, publisher: _change_publisher|None = None):
+        self.sites = sites
+        self.refreshed = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.fetch_base = fetch_stats()
+        self.publish_base = (publisher.published, publisher.suppressed) if publisher else (0, 0)
+
+    def log(self, publisher: _change_publisher):
+        elapsed = time.monotonic() - self.started
+        metrics.observe('jma_cycle_seconds', elapsed, 'duration of refresh and publish cycle')
+        metrics.inc('jma_mqtt_published_total', publisher.published - self.publish_base[0], 'published MQTT messages')
+        metrics.inc('jma_mqtt_suppressed_total', publisher.suppressed - self.publish_base[1], 'MQTT messages suppressed as unchanged')
+        metrics.inc('jma_refresh_failures_total', self.failed, 'failed refreshes')
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        fetched = fetch_stats()
+        logger.info(
+            'cycle sites=%d refreshed=%d failed=%d published=%d suppressed=%d %s elapsed_ms=%d',
+            self.sites, self.refreshed, self.failed,
+            publisher.published - self.publish_base[0], publisher.suppressed - self.publish_base[1],
+            ' '.join(f'{_k}={fetched[_k] - self.fetch_base[_k]}' for _k in self.fetch_keys),
+            elapsed * 1000,
+        )
+
+def export_metrics(mqtt_cli: mqtt.Client, mqtt_config: dict):
+    """
+    メトリクスを`JMA_METRICS_TEXTFILE`(Prometheus textfile)と`MQTT_TOPIC_METRICS`に書き出す
+    """
+    try:
+        metrics.write_textfile()
+    except OSError as e:
+        logger.warning('write metrics textfile failed: %r', e)
+    if mqtt_config['topic_metrics']:
+        # 毎回値が変わるので、変化の抑制もretainもしない
+        return mqtt_cli.publish(mqtt_config['topic_metrics'], metrics.to_json(), qos=0, retain=False)
+    return None
+
+def run_once(mqtt_config: dict, sites: list[dict]):
+    """
+    全地点の全データを取得して一度だけ送信する
+    """
+    summary = _cycle_summary(len(sites))
+    payloads = []
+    with fetch_cycle():
+        sites = [resolve_site(_site) for _site in sites]
+        amedas_snapshot.reset(sites)
+        for site in sites:
+            data = dict()
+            for refresh in refresh_funcs.values():
+                refresh(site, data)
+                summary.refreshed += 1
+            payloads.append((site, *build_payload(data)))
+
+    mqtt_cli = connect_mqtt(mqtt_config, sites)
+    publisher = create_publisher(mqtt_cli)
+    pubs = []
+    for site, state, attr in payloads:
+        pubs.extend(publish(publisher, site, state, attr))
+    # onlineは接続時に送られるので、接続を待ってその送信も待つ
+    userdata = mqtt_cli.user_data_get()
+    if userdata['connected'].wait(connect_timeout):
+        pubs.extend(userdata['online_pubs'])
+    summary.log(publisher)
+    pubs.append(export_metrics(mqtt_cli, mqtt_config))
+    #送信完了までプログラムを落とさないように待つ
+    for pub in pubs:
+        if pub is not None:
+            pub.wait_for_publish()
+    publisher.save()
+
+    mqtt_cli.disconnect()
+    mqtt_cli.loop_stop()
+
+def run_daemon(mqtt_config: dict, sites: list[dict]):
+    """
+    常駐して、データごとの更新間隔で取得し直して送信する
+    MQTTの接続、キャッシュ、地点の情報は保持し続ける
+    同じ時刻に更新する地点間では、同じURLのデータは一度だけ取得する
+    """
+    stop = threading.Event()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, lambda *_args: stop.set())
+
+    with fetch_cycle():
+        sites = [resolve_site(_site) for _site in sites]
+    mqtt_cli = connect_mqtt(mqtt_config, sites)
+    publisher = create_publisher(mqtt_cli)
+    datas = [dict() for _site in sites]
+    next_due = {(_i, _name): 0.0 for _i in range(len(sites)) for _name in refresh_funcs}
+    while not stop.is_set():
+        summary = _cycle_summary(len(sites), publisher)
+        with fetch_cycle():
+            amedas_snapshot.reset(sites)
+            for i, site in enumerate(sites):
+                data = datas[i]
+                refreshed = False
+                for name, refresh in refresh_funcs.items():
+                    now = time.monotonic()
+                    if next_due[(i, name)] > now:
+                        continue
+                    try:
+                        refresh(site, data)
+                        next_due[(i, name)] = now + refresh_intervals[name]
+                        refreshed = True
+                        summary.refreshed += 1
+                    except Exception as e: # 一時的な障害で常駐を止めない
+                        logger.warning('refresh %s of %s failed: %r', name, site['topic_stat'], e)
+                        summary.failed += 1
+                        next_due[(i, name)] = now + retry_interval
+                if refreshed and all(_k in data for _k in ['amedas', 'bunpu_weather', 'nowc_forecast', 'vpfd', 'forecast']):
+                    state, attr = build_payload(data)
+                    publish(publisher, site, state, attr)
+        publisher.save()
+        if summary.refreshed or summary.failed:
+            summary.log(publisher)
+            export_metrics(mqtt_cli, mqtt_config)
+        stop.wait(max(1.0, min(next_due.values()) - time.monotonic()))
+
+    pubs = [mqtt_cli.publish(_topic, 'offline', qos=1, retain=True) for _topic in availability_topics(mqtt_config, sites)]
+    for pub in pubs:
+        pub.wait_for_publish()
+    mqtt_cli.disconnect()
+    mqtt_cli.loop_stop()
+
+def main():
+    setup_logging()
+    mqtt_config = load_mqtt_config()
+    sites = load_sites()
+    if '--daemon' in sys.argv[1:] or os.environ.get('AMEDAS_MQTT_DAEMON', '').lower() in ['1', 'true', 'yes']:
+        run_daemon(mqtt_config, sites)
+    else:
+        run_once(mqtt_config, sites)
+
+if __name__ == '__main__':
+    main()
@@ -2,4 +2,13 @@
 AMeDAS
 https://www.jma.go.jp/bosai/map.html#&contents=amedas
 """
-from .jma_amedas import get_amedas_latest_time, get_amedas_point_data_latest, amedas_data_flatten
+from .jma_amedas import (
+    get_amedas_latest_time,
+    get_amedas_latest_time_async,
+    get_amedas_point_data_latest,
+    get_amedas_point_data_latest_async,
+    get_amedas_points_data_latest,
+    get_amedas_point,
+    get_amedas_points_nearest,
+    amedas_data_flatten,
+)
@@ -4,19 +4,116 @@ https://www.jma.go.jp/bosai/map.html#&contents=amedas
 """
 
 import datetime
-from jma_common import fetch_text, fetch_json, parse_dt_str
+import heapq
+import math
+import time
+from jma_common import fetch_text, fetch_json, fetch_text_async, fetch_json_async, parse_dt_str, timed
 
 amedastable_url : str = 'https://www.jma.go.jp/bosai/amedas/const/amedastable.json'
 amedas_latest_time_url : str = 'https://www.jma.go.jp/bosai/amedas/data/latest_time.txt'
 amedas_url_format : str = 'https://www.jma.go.jp/bosai/amedas/data/point/{amedas_point_cd}/{y:04d}{m:02d}{d:02d}_{h3:02d}.json'
+# 全地点のある時刻のデータ
+amedas_map_url_format : str = 'https://www.jma.go.jp/bosai/amedas/data/map/{dt:%Y%m%d%H%M%S}.json'
+
+# amedastableのelemsの各桁が表す観測要素('0'は観測なし)
+amedas_elem_names : list[str] = ['temp', 'precipitation', 'wind', 'sun', 'snow', 'humidity', 'pressure', 'visibility']
+# 地点一覧の索引を作り直すまでの秒数
+amedas_station_index_ttl : int = 24 * 60 * 60
+_earth_radius_km : float = 6371.0
 
 def get_amedas_latest_time() -> datetime.datetime:
     latest_txt : str = fetch_text(amedas_latest_time_url)
     latest_dt : datetime.datetime = parse_dt_str(latest_txt)
     return latest_dt
 
-def get_amedas_point(amedas_point_cd: str) -> dict:
-    pointjson : dict = fetch_json(amedastable_url)[amedas_point_cd]
+async def get_amedas_latest_time_async() -> datetime.datetime:
+    latest_txt : str = await fetch_text_async(amedas_latest_time_url)
+    return parse_dt_str(latest_txt)
+
+class _kd_tree:
+    """
+    3次元の点のk近傍探索、internal use only
+    """
+    def __init__(self, points: list[tuple[float,float,float]]):
+        self.points = points
+        self.root = self._build(list(range(len(points))), 0)
+
+    def _build(self, idxs: list[int], depth: int):
+        if not idxs:
+            return None
+        axis = depth % 3
+        idxs.sort(key=lambda _i: self.points[_i][axis])
+        mid = len(idxs) // 2
+        return (idxs[mid], axis, self._build(idxs[:mid], depth + 1), self._build(idxs[mid+1:], depth + 1))
+
+    def nearest(self, q: tuple[float,float,float], k: int, pred=None) -> list[tuple[float,int]]:
+        """
+        (距離の2乗, 点の番号)を近い順に最大k件。predを指定した場合は真になる点のみ
+        """
+        heap = [] # 距離の2乗を負にして最大ヒープにする
+        def visit(node):
+            if node is None:
+                return
+            idx, axis, left, right = node
+            p = self.points[idx]
+            if pred is None or pred(idx):
+                d2 = (q[0]-p[0])**2 + (q[1]-p[1])**2 + (q[2]-p[2])**2
+                if len(heap) < k:
+                    heapq.heappush(heap, (-d2, idx))
+                elif d2 < -heap[0][0]:
+                    heapq.heapreplace(heap, (-d2, idx))
+            diff = q[axis] - p[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            visit(near)
+            if len(heap) < k or diff * diff < -heap[0][0]:
+                visit(far)
+        visit(self.root)
+        return sorted((-_nd2, _i) for _nd2, _i in heap)
+
+def _latlon_to_xyz(lat: float, lon: float) -> tuple[float,float,float]:
+    # 単位球上の点。弦の長さは大円距離と単調に対応するので近傍探索にそのまま使える
+    lat_rad, lon_rad = math.radians(lat), math.radians(lon)
+    return (math.cos(lat_rad) * math.cos(lon_rad), math.cos(lat_rad) * math.sin(lon_rad), math.sin(lat_rad))
+
+class _amedas_station_index:
+    """
+    index of amedastable, internal use only
+
+    緯度経度は(度, 分)から10進に変換済みで持ち、近傍探索用のk-d木を作っておく
+    """
+    def __init__(self, amedastable: dict):
+        self.codes : list[str] = list(amedastable.keys())
+        self.stations : dict = {_cd : _amedas_station(_v) for _cd, _v in amedastable.items()}
+        self.tree = _kd_tree([_latlon_to_xyz(self.stations[_cd]['lat'], self.stations[_cd]['lon']) for _cd in self.codes])
+        self.built = time.monotonic()
+
+    def get(self, amedas_point_cd: str) -> dict:
+        return self.stations[amedas_point_cd]
+
+    def elems_pred(self, elems: list[str]):
+        """
+        predicate of station index observing all of elems
+        """
+        elem_idxs = [amedas_elem_names.index(_e) for _e in elems]
+        def pred(idx: int) -> bool:
+            station_elems = self.stations[self.codes[idx]]['elems']
+            return all(len(station_elems) > _i and station_elems[_i] != '0' for _i in elem_idxs)
+        return pred
+
+    def nearest(self, lat: float, lon: float, k: int = 1, elems: list[str]|None = None) -> list[dict]:
+        """
+        近い順にk地点。elemsを指定した場合は、その観測要素をすべて観測している地点のみ
+        """
+        found = self.tree.nearest(_latlon_to_xyz(lat, lon), k, self.elems_pred(elems) if elems else None)
+        return [
+            {
+                **self.stations[self.codes[_i]],
+                'cd' : self.codes[_i],
+                'distance' : 2 * _earth_radius_km * math.asin(min(1.0, math.sqrt(_d2) / 2)),
+            } for _d2, _i in found
+        ]
+
+def _amedas_station(pointjson: dict) -> dict:
     lat_t : tuple[int,float] = pointjson['lat']
     lon_t : tuple[int,float] = pointjson['lon']
     lat : float = lat_t[0] + lat_t[1] / 60 # 度が負の場合の分の扱いは確認が必要(国内に限る場合は考慮不要)
@@ -32,6 +129,26 @@ def get_amedas_point(amedas_point_cd: str) -> dict:
         'elems' : pointjson['elems']
     }
 
+_station_index : _amedas_station_index|None = None
+
+def get_amedas_station_index() -> _amedas_station_index:
+    """
+    地点一覧の索引。一度作ったものを`amedas_station_index_ttl`秒使い回す
+    """
+    global _station_index
+    if _station_index is None or time.monotonic() - _station_index.built > amedas_station_index_ttl:
+        _station_index = _amedas_station_index(fetch_json(amedastable_url, cache_key='amedastable'))
+    return _station_index
+
+def get_amedas_point(amedas_point_cd: str) -> dict:
+    return get_amedas_station_index().get(amedas_point_cd)
+
+def get_amedas_points_nearest(lat: float, lon: float, k: int = 1, elems: list[str]|None = None) -> list[dict]:
+    """
+    緯度経度に近いアメダス地点(`get_amedas_point`の内容に`cd`と`distance`(km)を加えたもの)
+    """
+    return get_amedas_station_index().nearest(lat, lon, k, elems)
+
 def get_amedas_url(amedas_point_cd: str, amedas_latest_dt: datetime.datetime) -> str:
     return amedas_url_format.format(
         amedas_point_cd = amedas_point_cd,
@@ -41,20 +158,71 @@ def get_amedas_url(amedas_point_cd: str, amedas_latest_dt: datetime.datetime) ->
         h3 = (amedas_latest_dt.hour // 3) * 3,
     )
 
-def get_amedas_point_data_raw(amedas_point_cd: str, dt: datetime.datetime) -> dict:
+def get_amedas_point_data_raw(amedas_point_cd: str, dt: datetime.datetime, **kwargs) -> dict:
     amedas_url : str = get_amedas_url(amedas_point_cd, dt)
-    amedas_data_all : dict = fetch_json(amedas_url)
+    amedas_data_all : dict = fetch_json(amedas_url, **kwargs)
     return amedas_data_all
 
+@timed('amedas')
 def get_amedas_point_data_latest(amedas_point_cd: str) -> dict:
     amedas_latest_dt : datetime.datetime = get_amedas_latest_time()
     amedas_data_all : dict = get_amedas_point_data_raw(amedas_point_cd, amedas_latest_dt)
+    if _amedas_data_key(amedas_latest_dt) not in amedas_data_all:
+        # ディスクキャッシュが最新時刻より古い場合は再検証する
+        amedas_data_all = get_amedas_point_data_raw(amedas_point_cd, amedas_latest_dt, max_age=0)
+    return _amedas_data_merge_latest(amedas_data_all, amedas_latest_dt)
+
+@timed('amedas')
+async def get_amedas_point_data_latest_async(amedas_point_cd: str) -> dict:
+    amedas_latest_dt : datetime.datetime = await get_amedas_latest_time_async()
+    amedas_url : str = get_amedas_url(amedas_point_cd, amedas_latest_dt)
+    amedas_data_all : dict = await fetch_json_async(amedas_url)
+    if _amedas_data_key(amedas_latest_dt) not in amedas_data_all:
+        amedas_data_all = await fetch_json_async(amedas_url, max_age=0)
+    return _amedas_data_merge_latest(amedas_data_all, amedas_latest_dt)
+
+def get_amedas_map_url(dt: datetime.datetime) -> str:
+    return amedas_map_url_format.format(dt=dt)
+
+def get_amedas_map_data_raw(dt: datetime.datetime, **kwargs) -> dict:
+    amedas_map_data : dict = fetch_json(get_amedas_map_url(dt), **kwargs)
+    return amedas_map_data
+
+@timed('amedas')
+def get_amedas_points_data_latest(amedas_point_cds: list[str]|None = None, amedas_latest_dt: datetime.datetime|None = None) -> dict:
+    """
+    全地点の最新時刻のデータ(地点ごとに`get_amedas_point_data_latest`と同じ形)を一括で取得する
+    最新時刻と毎時0分の2回の取得で、地点数によらない
+    `amedas_latest_dt`を省略した場合は最新時刻を取得する
+    """
+    if amedas_latest_dt is None:
+        amedas_latest_dt = get_amedas_latest_time()
+    amedas_map_data : dict = get_amedas_map_data_raw(amedas_latest_dt)
+    amedas_latest_dt0 : datetime.datetime = amedas_latest_dt.replace(minute=0, second=0, microsecond=0)
+    if amedas_latest_dt0 == amedas_latest_dt:
+        amedas_map_data0 : dict = amedas_map_data
+    else:
+        amedas_map_data0 : dict = get_amedas_map_data_raw(amedas_latest_dt0)
+    if amedas_point_cds is None:
+        amedas_point_cds = list(amedas_map_data.keys())
+    return {
+        _cd : _amedas_data_merge(amedas_map_data[_cd], amedas_map_data0.get(_cd, amedas_map_data[_cd]))
+        for _cd in amedas_point_cds if _cd in amedas_map_data
+    }
+
+def _amedas_data_key(amedas_latest_dt: datetime.datetime) -> str:
+    return amedas_latest_dt.strftime('%Y%m%d%H%M%S')
+
+def _amedas_data_merge_latest(amedas_data_all: dict, amedas_latest_dt: datetime.datetime) -> dict:
     # 最新時刻
-    data_k : str = amedas_latest_dt.strftime('%Y%m%d%H%M%S')
+    data_k : str = _amedas_data_key(amedas_latest_dt)
     amedas_data : dict = amedas_data_all[data_k]
     # 最新の毎時0分
     data_k0 : str = data_k[:-4]+'0000'
     amedas_data0 : dict = amedas_data_all[data_k0]
+    return _amedas_data_merge(amedas_data, amedas_data0)
+
+def _amedas_data_merge(amedas_data: dict, amedas_data0: dict) -> dict:
     # 最新データに、毎時0分のみ発表のデータをマージ
     amedas_data_j : dict = { _k : amedas_data[_k] if _k in amedas_data else amedas_data0[_k] for _k in amedas_data0 }
     return amedas_data_j
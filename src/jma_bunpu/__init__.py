@@ -2,4 +2,4 @@
 推計気象分布
 https://www.data.jma.go.jp/bunpu/
 """
-from .jma_bunpu import get_bunpu_area_coordinates,get_bunpu_weather
+from .jma_bunpu import get_bunpu_area_coordinates,get_bunpu_weather,get_bunpu_weather_frame,get_bunpu_area_coordinates_async,get_bunpu_weather_async,get_bunpu_weather_frame_async
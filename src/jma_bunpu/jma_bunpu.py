@@ -3,9 +3,21 @@
 https://www.data.jma.go.jp/bunpu/
 """
 import datetime
-import operator
+import json
+import math
+import os
+import struct
+import threading
+import time
 
-from jma_common import fetch_text,fetch_image,get_sunny_or_clear_night
+from jma_common import fetch_text,fetch_binary,fetch_image,fetch_exists,fetch_text_async,fetch_binary_async,fetch_image_async,fetch_exists_async,get_sunny_or_clear_night,timed
+
+# 地図の範囲の索引を作り直すまでの秒数
+bunpu_area_index_ttl = 24 * 60 * 60
+# 最新の画像を探すときに遡る上限(時間)
+bunpu_max_lookback_hours = int(os.environ.get('BUNPU_MAX_LOOKBACK_HOURS', '6'))
+# 存在しなかった画像を再確認するまでの秒数(複数地点で同じ時刻を何度も確認しないため)
+bunpu_missing_ttl = 60
 
 def _center_score_euclid(x, y, w, h):
     """
@@ -30,48 +42,252 @@ def _bunpu_areas_parse_line(line):
     dic['lvl'] = 1 if code=='000' else len(code)
     return dic
 
+bunpu_areas_url = 'https://www.data.jma.go.jp/bunpu//js/area.properties'
+
+class _bunpu_area_index:
+    """
+    index of area.properties, internal use only
+
+    地図の範囲を1度単位の格子に振り分けておき、点を含む範囲だけを調べる
+    """
+    def __init__(self, bunpu_areas_raw:str):
+        self.areas = [
+            _bunpu_areas_parse_line(_x)
+            for _x
+            in map(lambda _y:_y.strip(), bunpu_areas_raw.splitlines())
+            if len(_x)>0 and not _x.startswith('#')
+        ]
+        self.grid = dict()
+        for rect in self.areas:
+            for cell_lat in range(math.floor(rect['posS']), math.floor(rect['posN'])+1):
+                for cell_lon in range(math.floor(rect['posW']), math.floor(rect['posE'])+1):
+                    self.grid.setdefault((cell_lat, cell_lon), []).append(rect)
+        self.built = time.monotonic()
+
+    def select(self, lat:float, lon:float) -> dict:
+        """
+        点を含む地図のうち、解像度が高く最も中央に近いもの(地図内の相対位置x,yを含む)
+        """
+        selected = None
+        selected_key = None
+        for rect in self.grid.get((math.floor(lat), math.floor(lon)), []):
+            x = (lon-rect['posW'])/(rect['posE']-rect['posW'])
+            y = (rect['posN']-lat)/(rect['posN']-rect['posS'])
+            if not (0 <= x <= 1 and 0 <= y <= 1):
+                continue
+            # 最も中央に近いものを採用するため、ユークリッド距離を求める
+            key = (rect['lvl'], _center_score_euclid(x,y,1,1))
+            if selected_key is None or key > selected_key:
+                selected = {**rect, 'x': x, 'y': y, 's': key[1]}
+                selected_key = key
+        if selected is None:
+            raise ValueError(f'bunpu area not found: {lat}, {lon}')
+        return selected
+
+_area_index : _bunpu_area_index|None = None
+# 地図画像のサイズ(コードごと)
+_munic_sizes : dict = dict()
+
+def _bunpu_area_index_expired() -> bool:
+    return _area_index is None or time.monotonic() - _area_index.built > bunpu_area_index_ttl
+
+def get_bunpu_area_index() -> _bunpu_area_index:
+    """
+    地図の範囲の索引。一度作ったものを`bunpu_area_index_ttl`秒使い回す
+    """
+    global _area_index
+    if _bunpu_area_index_expired():
+        _area_index = _bunpu_area_index(fetch_text(bunpu_areas_url))
+    return _area_index
+
+async def get_bunpu_area_index_async() -> _bunpu_area_index:
+    global _area_index
+    if _bunpu_area_index_expired():
+        _area_index = _bunpu_area_index(await fetch_text_async(bunpu_areas_url))
+    return _area_index
+
+# PNGの署名とIHDR(幅と高さ)までのバイト数
+_png_header_range = {'Range': 'bytes=0-23'}
+
+def _png_size(binary:bytes) -> tuple[int,int]:
+    """
+    PNGのヘッダ(IHDR)から幅と高さを読む。画像全体はデコードしない
+    """
+    if binary[:8] != b'\x89PNG\r\n\x1a\n' or binary[12:16] != b'IHDR':
+        raise ValueError('not a PNG image')
+    return struct.unpack('>II', binary[16:24])
+
+def get_bunpu_tile_size(tile_cd:str) -> tuple[int,int]:
+    """
+    地図画像の幅と高さ。ヘッダの範囲だけを取得する(範囲指定に対応しないサーバでは全体)
+    """
+    if tile_cd not in _munic_sizes:
+        _munic_sizes[tile_cd] = _png_size(fetch_binary(_bunpu_munic_url(tile_cd), headers=_png_header_range))
+    return _munic_sizes[tile_cd]
+
+async def get_bunpu_tile_size_async(tile_cd:str) -> tuple[int,int]:
+    if tile_cd not in _munic_sizes:
+        _munic_sizes[tile_cd] = _png_size(await fetch_binary_async(_bunpu_munic_url(tile_cd), headers=_png_header_range))
+    return _munic_sizes[tile_cd]
+
 def get_bunpu_area_coordinates(lat:float, lon:float) -> tuple:
     """
     緯度経度から推計気象分布の地図座標を求める
     """
-    bunpu_areas_raw = fetch_text('https://www.data.jma.go.jp/bunpu//js/area.properties')
-    bunpu_areas = [
-        _bunpu_areas_parse_line(_x)
-        for _x
-        in map(lambda _y:_y.strip(), bunpu_areas_raw.splitlines())
-        if len(_x)>0 and not _x.startswith('#')
-    ]
-
-    for rect in bunpu_areas:
-        rect['x'] = (lon-rect['posW'])/(rect['posE']-rect['posW'])
-        rect['y'] = (rect['posN']-lat)/(rect['posN']-rect['posS'])
-        # 最も中央に近いものを採用するため、ユークリッド距離を求める
-        rect['s'] = _center_score_euclid(rect['x'],rect['y'],1,1)
-
-    # 解像度が高いマップの中で最も中央に近いものを選択
-    selected = sorted(bunpu_areas, key=operator.itemgetter('lvl', 's'), reverse=True)[0]
-
-    # マップ画像を取得し、そのサイズからピクセル位置を特定する
-    img=fetch_image(f'https://www.data.jma.go.jp/bunpu/img/munic/munic_{selected["code"]}.png')
-    px=int(selected['x'] * img.width)
-    py=int(selected['y'] * img.height)
+    selected = get_bunpu_area_index().select(lat, lon)
+    # マップ画像のサイズからピクセル位置を特定する
+    return _bunpu_area_pixel(selected, get_bunpu_tile_size(selected['code']))
+
+async def get_bunpu_area_coordinates_async(lat:float, lon:float) -> tuple:
+    """
+    緯度経度から推計気象分布の地図座標を求める (asyncio)
+    """
+    selected = (await get_bunpu_area_index_async()).select(lat, lon)
+    return _bunpu_area_pixel(selected, await get_bunpu_tile_size_async(selected['code']))
+
+def _bunpu_munic_url(tile_cd:str) -> str:
+    return f'https://www.data.jma.go.jp/bunpu/img/munic/munic_{tile_cd}.png'
+
+def _bunpu_area_pixel(selected:dict, size:tuple[int,int]) -> tuple:
+    width, height = size
+    px=int(selected['x'] * width)
+    py=int(selected['y'] * height)
     return selected['code'], px, py
 
-def get_bunpu_weather(tile_cd:str, px:int, py:int, dt:datetime):
+def _bunpu_weather_url(tile_cd:str, dt:datetime) -> str:
+    dt_s = dt.strftime('%Y%m%d%H')+'00'
+    # ご参考：
+    # 地形地図： https://www.data.jma.go.jp/bunpu/img/bgmap/bg_{tile_cd}.jpg
+    # 行政地図： https://www.data.jma.go.jp/bunpu/img/munic/munic_{tile_cd}.png
+    return f'https://www.data.jma.go.jp/bunpu/img/wthr/{tile_cd}/wthr_{tile_cd}_{dt_s}.png'
+
+class _bunpu_latest_frame:
+    """
+    latest frame discovery of bunpu weather images, internal use only
+
+    推計気象分布は最新時刻が提供されないので、新しい時刻から順に存在確認(HEAD)して探す
+    見つかった時刻はタイルごとに覚え(`JMA_CACHE_DIR`がある場合は保存し)、次回はそれより新しい時刻だけを確認する
+    """
+    def __init__(self, store_path:str|None = None):
+        self.store_path = store_path
+        self.known = dict() # tile_cd -> 'YYYYmmddHH'
+        self.missing = dict() # url -> 確認した時刻
+        self.lock = threading.Lock()
+        if store_path:
+            try:
+                with open(store_path, 'rt', encoding='utf-8') as storef:
+                    self.known = json.load(storef)
+            except (OSError, ValueError):
+                pass
+
+    def candidates(self, tile_cd:str, dt:datetime.datetime) -> list[tuple[datetime.datetime, bool]]:
+        """
+        確認する時刻を新しい順に返す。(時刻, 確認済みか)
+        前回見つかった時刻より古いものは確認しない
+        """
+        top = dt.replace(minute=0, second=0, microsecond=0)
+        known = self.known.get(tile_cd)
+        result = []
+        for hours in range(bunpu_max_lookback_hours + 1):
+            frame_dt = top - datetime.timedelta(hours=hours)
+            if frame_dt.strftime('%Y%m%d%H') == known:
+                result.append((frame_dt, True))
+                break
+            if not self.recently_missing(_bunpu_weather_url(tile_cd, frame_dt)):
+                result.append((frame_dt, False))
+        return result
+
+    def recently_missing(self, url:str) -> bool:
+        checked = self.missing.get(url)
+        return checked is not None and time.monotonic() - checked < bunpu_missing_ttl
+
+    def set_missing(self, url:str):
+        self.missing[url] = time.monotonic()
+
+    def set_found(self, tile_cd:str, frame_dt:datetime.datetime):
+        key = frame_dt.strftime('%Y%m%d%H')
+        with self.lock:
+            if self.known.get(tile_cd) == key:
+                return
+            self.known[tile_cd] = key
+            if self.store_path:
+                os.makedirs(os.path.dirname(self.store_path), exist_ok=True)
+                with open(self.store_path, 'wt', encoding='utf-8') as storef:
+                    json.dump(self.known, storef)
+
+def _bunpu_latest_frame_store() -> str|None:
+    cache_dir = os.environ.get('JMA_CACHE_DIR')
+    return os.path.join(cache_dir, 'bunpu_latest.json') if cache_dir else None
+
+_latest_frame = _bunpu_latest_frame(_bunpu_latest_frame_store())
+
+def get_bunpu_latest_frame(tile_cd:str, dt:datetime.datetime) -> datetime.datetime|None:
+    """
+    `dt`以前で最新の推計気象分布の時刻。`bunpu_max_lookback_hours`時間遡っても無ければNone
+    """
+    for frame_dt, known in _latest_frame.candidates(tile_cd, dt):
+        url = _bunpu_weather_url(tile_cd, frame_dt)
+        if known or fetch_exists(url):
+            _latest_frame.set_found(tile_cd, frame_dt)
+            return frame_dt
+        _latest_frame.set_missing(url)
+    return None
+
+async def get_bunpu_latest_frame_async(tile_cd:str, dt:datetime.datetime) -> datetime.datetime|None:
+    """
+    `dt`以前で最新の推計気象分布の時刻 (asyncio)
+    """
+    for frame_dt, known in _latest_frame.candidates(tile_cd, dt):
+        url = _bunpu_weather_url(tile_cd, frame_dt)
+        if known or await fetch_exists_async(url):
+            _latest_frame.set_found(tile_cd, frame_dt)
+            return frame_dt
+        _latest_frame.set_missing(url)
+    return None
+
+@timed('bunpu')
+def get_bunpu_weather_frame(tile_cd:str, px:int, py:int, dt:datetime.datetime) -> dict:
+    """
+    推計気象分布の地図から地点の天気と、その画像の時刻、`dt`からの遅れ(秒)を返す
+    画像が見つからない場合、天気は'unknown'、時刻と遅れはNone
+    """
+    frame_dt = get_bunpu_latest_frame(tile_cd, dt)
+    if frame_dt is None:
+        return _bunpu_weather_frame('unknown', None, dt)
+    img = fetch_image(_bunpu_weather_url(tile_cd, frame_dt))
+    return _bunpu_weather_frame(_bunpu_weather_by_color(img.getpixel((px,py)), frame_dt), frame_dt, dt)
+
+@timed('bunpu')
+async def get_bunpu_weather_frame_async(tile_cd:str, px:int, py:int, dt:datetime.datetime) -> dict:
+    """
+    推計気象分布の地図から地点の天気と、その画像の時刻、`dt`からの遅れ(秒)を返す (asyncio)
+    """
+    frame_dt = await get_bunpu_latest_frame_async(tile_cd, dt)
+    if frame_dt is None:
+        return _bunpu_weather_frame('unknown', None, dt)
+    img = await fetch_image_async(_bunpu_weather_url(tile_cd, frame_dt))
+    return _bunpu_weather_frame(_bunpu_weather_by_color(img.getpixel((px,py)), frame_dt), frame_dt, dt)
+
+def _bunpu_weather_frame(weather:str, frame_dt:datetime.datetime|None, dt:datetime.datetime) -> dict:
+    return {
+        'weather': weather,
+        'time': frame_dt,
+        'stale': (dt - frame_dt).total_seconds() if frame_dt is not None else None,
+    }
+
+def get_bunpu_weather(tile_cd:str, px:int, py:int, dt:datetime.datetime) -> str:
     """
     推計気象分布の地図から地点の天気を返す
     """
-    while True: # 最新の時刻が提供されないので、見つかるまで遡り続ける
-        # TODO リミッター
-        dt_s = dt.strftime('%Y%m%d%H')+'00'
-        img = fetch_image(f'https://www.data.jma.go.jp/bunpu/img/wthr/{tile_cd}/wthr_{tile_cd}_{dt_s}.png', raise_error=False)
-        # ご参考：
-        # 地形地図： https://www.data.jma.go.jp/bunpu/img/bgmap/bg_{tile_cd}.jpg
-        # 行政地図： https://www.data.jma.go.jp/bunpu/img/munic/munic_{tile_cd}.png
-        if img is not None:
-            break
-        dt = dt - datetime.timedelta(hours=1)
-    pxl_color=img.getpixel((px,py))
+    return get_bunpu_weather_frame(tile_cd, px, py, dt)['weather']
+
+async def get_bunpu_weather_async(tile_cd:str, px:int, py:int, dt:datetime.datetime) -> str:
+    """
+    推計気象分布の地図から地点の天気を返す (asyncio)
+    """
+    return (await get_bunpu_weather_frame_async(tile_cd, px, py, dt))['weather']
+
+def _bunpu_weather_by_color(pxl_color:tuple, dt:datetime) -> str:
     match pxl_color:
         case (0xff, 0xaa, 0x00, 0xff):
             return get_sunny_or_clear_night(dt)
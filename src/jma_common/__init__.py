@@ -6,12 +6,24 @@ from .jma_common import (
     fetch_json,
     fetch_binary,
     fetch_image,
+    fetch_exists,
+    fetch_text_async,
+    fetch_json_async,
+    fetch_binary_async,
+    fetch_image_async,
+    fetch_exists_async,
+    fetch_cycle,
+    fetch_stats,
     parse_dt_str,
     format_dt_str,
     fetch_area,
+    fetch_area_async,
     get_area_cd_center_by_office,
     get_area_cd_office_by_class10,
+    get_area_cd_office_by_class10_async,
     get_area_cd_class10_by_class15,
     get_area_cd_class15_by_class20,
     get_sunny_or_clear_night,
 )
+from .jma_logging import setup_logging
+from .jma_metrics import metrics, timed
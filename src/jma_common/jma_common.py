@@ -2,74 +2,348 @@
 common utilities
 """
 
+import contextlib
 import datetime
 from io import BytesIO
 import json
-import requests
-from PIL import Image
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
 
-_DEBUG_ADDRESS_ = True
+from .jma_disk_cache import disk_cache
+from .jma_mem_cache import _lru_cache, default_max_bytes
+from .jma_metrics import metrics
+
+# requests, aiohttp, PILは読み込みに時間がかかるので、使うときに読み込む(ディスクキャッシュだけで済む場合は読み込まない)
+
+logger = logging.getLogger(__name__)
 
 area_url: str = 'https://www.jma.go.jp/bosai/common/const/area.json'
 area_xy_url: str = 'https://www.jma.go.jp/bosai/common/const/xy.json'
 
+_missing = object()
+# 404など取得できなかったもの(raise_errorがFalse)をキャッシュする秒数
+_error_cache_ttl = 600
+
 class _cache:
     """
     cache class, internal use only
     """
-    def __init__(self):
-        self.caches = dict()
+    def __init__(self, max_bytes:int|None=None):
+        # 取得したデータとデコード済みの画像(キーは('image', URL, 変換後のモード))で上限を共有する
+        self.caches = _lru_cache(max_bytes if max_bytes is not None else default_max_bytes())
+        # fetch_cycle中に取得したデータ(URLごと)
+        self.cycle = None
+        self.cycle_depth = 0
+        self.cycle_lock = threading.Lock()
+        # 取得の件数(サイクルごとの集計用)
+        self.counters = dict.fromkeys(['requests', 'not_modified', 'disk_hits', 'cycle_hits', 'errors'], 0)
+        self.counters_lock = threading.Lock()
 
-    def get(self, datatype:type, url:str, cache_key:str|None = None, **kwargs)->str|bytes:
+    def get(self, datatype:type, url:str, cache_key:str|None = None, cache_ttl:float|None = None, **kwargs)->str|bytes:
         """
         get data, using cache or not
         """
         if cache_key:
-            return self.get_cache_or_fetch(datatype,url,cache_key,**kwargs)
-        return self.fetch(datatype,url,**kwargs)
+            return self.get_cache_or_fetch(datatype,url,cache_key,cache_ttl,**kwargs)
+        cached = self.get_cycle(datatype, url, kwargs)
+        if cached is not _missing:
+            return cached
+        raw = self.fetch(datatype,url,**kwargs)
+        self.set_cycle(datatype, url, raw, kwargs)
+        return raw
+
+    async def get_async(self, datatype:type, url:str, cache_key:str|None = None, cache_ttl:float|None = None, **kwargs)->str|bytes:
+        """
+        get data, using cache or not (asyncio)
+        """
+        if cache_key:
+            cached = self.caches.get(cache_key, _missing)
+        else:
+            cached = self.get_cycle(datatype, url, kwargs)
+        if cached is not _missing:
+            return cached
+        raw = await self.fetch_async(datatype, url, **kwargs)
+        if cache_key:
+            self.set_cache_fetched(cache_key, url, raw, cache_ttl)
+        else:
+            self.set_cycle(datatype, url, raw, kwargs)
+        return raw
+
+    def begin_cycle(self):
+        with self.cycle_lock:
+            if self.cycle_depth == 0:
+                self.cycle = dict()
+            self.cycle_depth += 1
 
-    def get_cache_or_fetch(self, datatype:type, url:str, cache_key:str, **kwargs)->str|bytes:
+    def end_cycle(self):
+        with self.cycle_lock:
+            self.cycle_depth -= 1
+            if self.cycle_depth == 0:
+                self.cycle = None
+
+    def get_cycle(self, datatype:type, url:str, kwargs:dict)->str|bytes|None:
+        """
+        get data fetched in current cycle, `_missing` if not in cycle
+        """
+        cycle = self.cycle
+        if cycle is None or 'max_age' in kwargs: # 鮮度を指定した再取得はサイクル内でも取得し直す
+            return _missing
+        cached = cycle.get(self.cycle_key(datatype, url, kwargs), _missing)
+        if cached is not _missing:
+            self.count('cycle_hits')
+        return cached
+
+    def set_cycle(self, datatype:type, url:str, raw:str|bytes|None, kwargs:dict):
+        cycle = self.cycle
+        if cycle is not None:
+            cycle[self.cycle_key(datatype, url, kwargs)] = raw
+
+    def cycle_key(self, datatype:type, url:str, kwargs:dict)->tuple:
+        # 範囲指定(Range)の取得は、全体の取得と区別する
+        return (datatype, url, kwargs.get('headers', {}).get('Range'))
+
+    def get_cache_or_fetch(self, datatype:type, url:str, cache_key:str, cache_ttl:float|None=None, **kwargs)->str|bytes:
         """
         get data using cache, or fetch if missing
         """
-        cached = self.caches.get(cache_key, None)
-        if cached:
+        cached = self.caches.get(cache_key, _missing)
+        if cached is not _missing:
             return cached
         raw = self.fetch(datatype, url, **kwargs)
-        self.set_cache(cache_key, raw)
+        self.set_cache_fetched(cache_key, url, raw, cache_ttl)
         return raw
 
-    def fetch(self, datatype:type, url:str, raise_error:bool=True, timeout:int=3000,**kwargs)->str|bytes:
+    def set_cache_fetched(self, cache_key:str, url:str, raw:str|bytes|None, cache_ttl:float|None):
+        """
+        add fetched data to cache
+
+        `cache_ttl`を省略した場合、URLの鮮度ルールをTTLとする(ルールがなければ無期限)
+        取得できなかった場合(raise_errorがFalseで404など)もNoneを短い間だけ保持し、呼び出しごとに再取得しない
+        """
+        if raw is None:
+            cache_ttl = _error_cache_ttl
+        elif cache_ttl is None:
+            cache_ttl = disk_cache.freshness(url)
+        self.set_cache(cache_key, raw, cache_ttl)
+
+    def fetch(self, datatype:type, url:str, raise_error:bool=True, timeout:float|tuple|None=None, max_age:int|None=None,
+              retries:int|None=None, backoff_factor:float|None=None, use_disk_cache:bool=True, **kwargs)->str|bytes:
+        """
+        get data from URL, not use memory cache
+
+        `raise_error`がFalseの場合、エラー(404など)はNoneを返す
+        ディスクキャッシュが有効な場合、鮮度内ならディスクから返し、期限切れなら条件付きGETで再検証する
+        `max_age`で鮮度(秒)のルールを上書きできる
+        `use_disk_cache`がFalseの場合はディスクキャッシュを読み書きしない(呼び出し側で別に保存するデータ向け)
+        `timeout`, `retries`, `backoff_factor`を省略した場合は`jma_session`の既定値
+        """
+        max_age, stored = self.load_stored(url, max_age) if use_disk_cache else (None, None)
+        if stored and disk_cache.is_fresh(stored[0], max_age):
+            self.count('disk_hits')
+            return self.decode(datatype, stored[1], stored[0]['encoding'])
+        kwargs = self.conditional_kwargs(stored, kwargs)
+        self.count('requests')
+        from .jma_session import request_get
+        with self.measure('GET', url) as measured:
+            resp = measured(request_get(url, timeout=timeout, retries=retries, backoff_factor=backoff_factor, **kwargs))
+        return self.handle_response(datatype, url, resp, stored, max_age, raise_error)
+
+    async def fetch_async(self, datatype:type, url:str, raise_error:bool=True, timeout:float|tuple|None=None, max_age:int|None=None,
+                          retries:int|None=None, backoff_factor:float|None=None, use_disk_cache:bool=True, **kwargs)->str|bytes:
+        """
+        get data from URL, not use memory cache (asyncio)
+        """
+        max_age, stored = self.load_stored(url, max_age) if use_disk_cache else (None, None)
+        if stored and disk_cache.is_fresh(stored[0], max_age):
+            self.count('disk_hits')
+            return self.decode(datatype, stored[1], stored[0]['encoding'])
+        kwargs = self.conditional_kwargs(stored, kwargs)
+        self.count('requests')
+        from .jma_session_async import request_get_async
+        with self.measure('GET', url) as measured:
+            resp = measured(await request_get_async(url, timeout=timeout, retries=retries, backoff_factor=backoff_factor, **kwargs))
+        return self.handle_response(datatype, url, resp, stored, max_age, raise_error)
+
+    def exists(self, url:str, timeout:float|tuple|None=None, retries:int|None=None, backoff_factor:float|None=None)->bool:
+        """
+        check existence of URL by HEAD, without downloading body
+
+        ディスクキャッシュに保存済みなら問い合わせない
+        """
+        if self.stored_exists(url):
+            return True
+        self.count('requests')
+        from .jma_session import request_head
+        with self.measure('HEAD', url) as measured:
+            resp = measured(request_head(url, timeout=timeout, retries=retries, backoff_factor=backoff_factor))
+        return self.handle_exists(url, resp)
+
+    async def exists_async(self, url:str, timeout:float|tuple|None=None, retries:int|None=None, backoff_factor:float|None=None)->bool:
+        """
+        check existence of URL by HEAD, without downloading body (asyncio)
+        """
+        if self.stored_exists(url):
+            return True
+        self.count('requests')
+        from .jma_session_async import request_head_async
+        with self.measure('HEAD', url) as measured:
+            resp = measured(await request_head_async(url, timeout=timeout, retries=retries, backoff_factor=backoff_factor))
+        return self.handle_exists(url, resp)
+
+    @contextlib.contextmanager
+    def measure(self, method:str, url:str):
+        """
+        record latency, status and bytes of request made in block
+
+        ブロック内で応答を`measured(resp)`に渡す。例外(接続エラーなど)は失敗として数える
         """
-        get data from URL, not use cache
+        host = urlsplit(url).netloc
+        started = time.perf_counter()
+        def measured(resp:any)->any:
+            metrics.observe('jma_fetch_request_seconds', time.perf_counter() - started, 'latency of HTTP request including retries', host=host, method=method)
+            metrics.inc('jma_fetch_responses_total', 1, 'HTTP responses by status', host=host, status=resp.status_code)
+            if method == 'GET':
+                metrics.inc('jma_fetch_response_bytes_total', len(resp.content), 'received body bytes', host=host)
+            return resp
+        try:
+            yield measured
+        except Exception:
+            metrics.inc('jma_fetch_failures_total', 1, 'HTTP requests failed without response', host=host, method=method)
+            raise
+
+    def stored_exists(self, url:str)->bool:
+        return disk_cache.enabled and disk_cache.freshness(url) is not None and disk_cache.load(url) is not None
+
+    def handle_exists(self, url:str, resp:any)->bool:
+        logger.debug('HEAD %s %s %s', url, resp.status_code, resp.reason)
+        if resp.status_code >= 500:
+            self.count('errors') # 存在しないのではなく、確認できなかった
+            resp.raise_for_status()
+        return resp.status_code == 200
+
+    def load_stored(self, url:str, max_age:int|None)->tuple[int|None,tuple[dict,bytes]|None]:
+        """
+        get max age of URL and data stored in disk cache
+        """
+        if max_age is None:
+            max_age = disk_cache.freshness(url)
+        stored = disk_cache.load(url) if disk_cache.enabled and max_age is not None else None
+        return max_age, stored
+
+    def conditional_kwargs(self, stored:tuple[dict,bytes]|None, kwargs:dict)->dict:
         """
-        if _DEBUG_ADDRESS_:
-            print(url)
-        resp = requests.get(url, timeout=timeout, **kwargs)
-        if _DEBUG_ADDRESS_:
-            print(f'{resp.status_code} {resp.reason}')
+        add headers for conditional request
+        """
+        if not stored:
+            return kwargs
+        return dict(kwargs, headers={**disk_cache.validators(stored[0]), **kwargs.get('headers', {})})
+
+    def handle_response(self, datatype:type, url:str, resp:any, stored:tuple[dict,bytes]|None, max_age:int|None, raise_error:bool)->str|bytes:
+        """
+        convert response to datatype, and store it to disk cache
+        """
+        logger.debug('GET %s %s %s', url, resp.status_code, resp.reason)
+        if resp.status_code == 304 and stored:
+            self.count('not_modified')
+            meta, body = stored
+            disk_cache.touch(url, meta)
+            return self.decode(datatype, body, meta['encoding'])
+        if resp.status_code >= 400:
+            self.count('errors')
         if raise_error:
             resp.raise_for_status()
+        elif resp.status_code >= 400:
+            return None
+        if datatype not in (str, bytes):
+            raise ValueError(f'invalid datatype: {datatype}')
+        # 文字コードの推定(apparent_encoding)は重いので、テキストの場合だけ行う。バイナリはNoneのまま保存する
+        encoding = (resp.encoding or resp.apparent_encoding) if datatype == str else resp.encoding
+        if resp.status_code == 200 and disk_cache.enabled and max_age is not None:
+            disk_cache.store(url, resp.content, resp.headers, encoding)
+        return self.decode(datatype, resp.content, encoding)
+
+    def decode(self, datatype:type, body:bytes, encoding:str|None)->str|bytes:
+        """
+        convert stored body to datatype
+        """
         if datatype == str:
-            return resp.text
+            return str(body, encoding or 'utf-8', errors='replace')
         elif datatype == bytes:
-            return resp.content
+            return body
         raise ValueError(f'invalid datatype: {datatype}')
 
     def del_cache(self, cache_key:str):
         """
         delete data from cache
         """
-        if cache_key in self.caches:
-            del self.caches[cache_key]
+        self.caches.delete(cache_key)
 
-    def set_cache(self, cache_key:str, data:str|bytes):
+    def set_cache(self, cache_key:str, data:str|bytes, ttl:float|None=None):
         """
         add cache data
         """
-        self.caches[cache_key] = data
+        self.caches.set(cache_key, data, ttl)
+
+    def get_image(self, url:str, mode:str|None)->any:
+        """
+        get decoded image, None if missing
+        """
+        return self.caches.get(('image', url, mode))
+
+    def set_image(self, url:str, mode:str|None, img:any):
+        """
+        add decoded image, expires with freshness rule of URL
+        """
+        self.caches.set(('image', url, mode), img, disk_cache.freshness(url))
+
+    def count(self, name:str):
+        with self.counters_lock:
+            self.counters[name] += 1
+
+    def stats(self)->dict:
+        """
+        fetch counters, with memory cache counters
+        """
+        with self.counters_lock:
+            counters = dict(self.counters)
+        return dict(counters, memory=self.caches.stats())
+
+    def collect_metrics(self)->list[tuple]:
+        """
+        cache counters as metrics samples
+        """
+        stats = self.stats()
+        samples = [('jma_fetch_cache_events_total', 'counter', 'fetch results by source', {'event': _k}, stats[_k])
+                   for _k in ['requests', 'not_modified', 'disk_hits', 'cycle_hits', 'errors']]
+        samples.extend([
+            ('jma_mem_cache_hits_total', 'counter', 'memory cache hits', {}, stats['memory']['hits']),
+            ('jma_mem_cache_misses_total', 'counter', 'memory cache misses', {}, stats['memory']['misses']),
+            ('jma_mem_cache_bytes', 'gauge', 'memory cache usage', {}, stats['memory']['bytes']),
+        ])
+        return samples
 
 cache = _cache()
+metrics.register_collector(cache.collect_metrics)
+
+@contextlib.contextmanager
+def fetch_cycle():
+    """
+    ブロック内では、キャッシュキーなしの取得でも同じURLは一度だけ取得する
+    複数地点で共有するデータ(府県予報、ナウキャストのタイルなど)を地点ごとに取得しないために使う
+    """
+    cache.begin_cycle()
+    try:
+        yield
+    finally:
+        cache.end_cycle()
+
+def fetch_stats()->dict:
+    """
+    起動してからの取得件数(リクエスト、304、ディスク・サイクル内の再利用)とメモリキャッシュの統計
+    """
+    return cache.stats()
 
 def fetch_text(url:str, cache_key:str|None=None, **kwargs)->str:
     """
@@ -84,7 +358,8 @@ def fetch_json(url:str, cache_key:str|None=None, **kwargs)->any:
     text = fetch_text(url,cache_key=cache_key, **kwargs)
     if text is None: # raise errorがFalseで404など
         return None
-    json_obj = json.loads(text)
+    with metrics.timer('jma_decode_seconds', 'decode time of fetched data', kind='json'):
+        json_obj = json.loads(text)
     return json_obj
 
 def fetch_binary(url:str, cache_key:str|None=None, **kwargs)->any:
@@ -93,14 +368,80 @@ def fetch_binary(url:str, cache_key:str|None=None, **kwargs)->any:
     """
     return cache.get(bytes, url, cache_key, **kwargs)
 
-def fetch_image(url:str, cache_key:str|None=None, **kwargs)->any:
+def fetch_image(url:str, cache_key:str|None=None, mode:str|None=None, **kwargs)->any:
     """
     fetch image from URL
+
+    `mode`を指定した場合はそのモード(RGBAなど)に変換する
+    デコードした画像はURLとモードごとにメモリにキャッシュして共有するので、変更しないこと
     """
+    img = cache.get_image(url, mode) if 'max_age' not in kwargs else None
+    if img is not None:
+        return img
     binary = fetch_binary(url, cache_key, **kwargs)
     if binary is None: # raise errorがFalseで404など
         return None
-    return  Image.open(BytesIO(binary))
+    img = _decode_image(binary, mode)
+    cache.set_image(url, mode, img)
+    return img
+
+def _decode_image(binary:bytes, mode:str|None)->any:
+    from PIL import Image
+    with metrics.timer('jma_decode_seconds', 'decode time of fetched data', kind='image'):
+        img = Image.open(BytesIO(binary))
+        if mode and img.mode != mode:
+            return img.convert(mode)
+        # 複数スレッドから参照されるので、遅延読み込みを済ませておく
+        img.load()
+        return img
+
+def fetch_exists(url:str, **kwargs)->bool:
+    """
+    check if URL exists, without downloading body
+    """
+    return cache.exists(url, **kwargs)
+
+async def fetch_exists_async(url:str, **kwargs)->bool:
+    """
+    check if URL exists, without downloading body (asyncio)
+    """
+    return await cache.exists_async(url, **kwargs)
+
+async def fetch_text_async(url:str, cache_key:str|None=None, **kwargs)->str:
+    """
+    fetch text data from URL (asyncio)
+    """
+    return await cache.get_async(str, url, cache_key, **kwargs)
+
+async def fetch_json_async(url:str, cache_key:str|None=None, **kwargs)->any:
+    """
+    fetch json data from URL (asyncio)
+    """
+    text = await fetch_text_async(url, cache_key=cache_key, **kwargs)
+    if text is None: # raise errorがFalseで404など
+        return None
+    with metrics.timer('jma_decode_seconds', 'decode time of fetched data', kind='json'):
+        return json.loads(text)
+
+async def fetch_binary_async(url:str, cache_key:str|None=None, **kwargs)->any:
+    """
+    fetch binary data from URL (asyncio)
+    """
+    return await cache.get_async(bytes, url, cache_key, **kwargs)
+
+async def fetch_image_async(url:str, cache_key:str|None=None, mode:str|None=None, **kwargs)->any:
+    """
+    fetch image from URL (asyncio)
+    """
+    img = cache.get_image(url, mode) if 'max_age' not in kwargs else None
+    if img is not None:
+        return img
+    binary = await fetch_binary_async(url, cache_key, **kwargs)
+    if binary is None: # raise errorがFalseで404など
+        return None
+    img = _decode_image(binary, mode)
+    cache.set_image(url, mode, img)
+    return img
 
 def parse_dt_str(dt_str:str)->datetime.datetime:
     """
@@ -120,6 +461,12 @@ def fetch_area(use_cache:bool=True):
     """
     return fetch_json(area_url, cache_key='area' if use_cache else None)
 
+async def fetch_area_async(use_cache:bool=True):
+    """
+    fetch `area` data (asyncio)
+    """
+    return await fetch_json_async(area_url, cache_key='area' if use_cache else None)
+
 def fetch_area_xy(use_cache:bool=True):
     """
     fetch `area xy` data
@@ -140,6 +487,13 @@ def get_area_cd_office_by_class10(class10_cd:str, use_cache:bool=True)-> str:
     area_data = fetch_area(use_cache=use_cache)
     return area_data['class10s'][class10_cd]['parent']
 
+async def get_area_cd_office_by_class10_async(class10_cd:str, use_cache:bool=True)-> str:
+    """
+    get area_cd of office by class10 in `area` data (asyncio)
+    """
+    area_data = await fetch_area_async(use_cache=use_cache)
+    return area_data['class10s'][class10_cd]['parent']
+
 def get_area_cd_class10_by_class15(class15_cd:str, use_cache:bool=True)-> str:
     """
     get area_cd of class10 by class15 in `area` data
@@ -0,0 +1,124 @@
+"""
+persistent on-disk HTTP cache
+
+`JMA_CACHE_DIR`環境変数でキャッシュディレクトリを指定した場合のみ有効
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+_cache_dir_env = 'JMA_CACHE_DIR'
+
+_day = 24 * 60 * 60
+
+# URL系統ごとの鮮度(秒)。上から順に評価し、最初にマッチしたものを採用する
+# 0 は保存はするが毎回条件付きGETで再検証する。どれにもマッチしないURLはディスクに保存しない
+freshness_rules: list[tuple[re.Pattern, int]] = [
+    # 定数類(area.json, amedastable.jsonなど)
+    (re.compile(r'^https://www\.jma\.go\.jp/bosai/[a-z]+/const/'), 3 * _day),
+    (re.compile(r'^https://www\.data\.jma\.go\.jp/bunpu//?js/area\.properties$'), 3 * _day),
+    (re.compile(r'^https://www\.data\.jma\.go\.jp/bunpu/img/munic/'), 30 * _day),
+    (re.compile(r'^https://www\.jma\.go\.jp/tile/gsi/'), 30 * _day),
+    # 推計気象分布は時刻ごとに別URLで、一度出たものは変わらない
+    (re.compile(r'^https://www\.data\.jma\.go\.jp/bunpu/img/wthr/'), _day),
+    # 最新時刻を指すファイルは常に再検証
+    (re.compile(r'^https://www\.jma\.go\.jp/bosai/amedas/data/latest_time\.txt$'), 0),
+    (re.compile(r'^https://www\.jma\.go\.jp/bosai/amedas/data/'), 10 * 60),
+    (re.compile(r'^https://www\.jma\.go\.jp/bosai/jmatile/data/nowc/targetTimes_'), 0),
+    (re.compile(r'^https://www\.jma\.go\.jp/bosai/jmatile/data/nowc/'), 5 * 60),
+    # 予報は発表時刻が不定なので再検証のみ
+    (re.compile(r'^https://www\.jma\.go\.jp/bosai/forecast/data/'), 0),
+    (re.compile(r'^https://www\.jma\.go\.jp/bosai/jmatile/data/wdist/'), 0),
+]
+
+class _disk_cache:
+    """
+    disk cache class, internal use only
+    """
+    def __init__(self, cache_dir:str|None = None):
+        self.cache_dir = cache_dir
+
+    @property
+    def enabled(self)->bool:
+        return bool(self.cache_dir)
+
+    def freshness(self, url:str)->int|None:
+        """
+        get max age(sec) of URL, None if URL is not to be stored
+        """
+        for pattern, max_age in freshness_rules:
+            if pattern.match(url):
+                return max_age
+        return None
+
+    def _paths(self, url:str)->tuple[str,str]:
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, digest[:2], digest)
+        return base + '.json', base + '.bin'
+
+    def load(self, url:str)->tuple[dict,bytes]|None:
+        """
+        load stored metadata and body, None if missing
+        """
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, 'rt', encoding='utf-8') as metaf:
+                meta = json.load(metaf)
+            with open(body_path, 'rb') as bodyf:
+                body = bodyf.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url: # ハッシュ衝突
+            return None
+        return meta, body
+
+    def is_fresh(self, meta:dict, max_age:int)->bool:
+        return time.time() - meta['fetched'] < max_age
+
+    def validators(self, meta:dict)->dict:
+        """
+        headers for conditional request
+        """
+        headers = dict()
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def store(self, url:str, body:bytes, headers:dict, encoding:str|None):
+        """
+        store response body and validators
+        """
+        meta = {
+            'url': url,
+            'fetched': time.time(),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'encoding': encoding,
+        }
+        meta_path, body_path = self._paths(url)
+        self._write(body_path, body)
+        self._write(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def touch(self, url:str, meta:dict):
+        """
+        mark stored data as revalidated (304 Not Modified)
+        """
+        meta = dict(meta, fetched=time.time())
+        meta_path, _ = self._paths(url)
+        self._write(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def _write(self, path:str, data:bytes):
+        # 途中で落ちても壊れたファイルを残さないように置き換える
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as tmpf:
+            tmpf.write(data)
+        os.replace(tmp_path, path)
+
+disk_cache = _disk_cache(os.environ.get(_cache_dir_env))
@@ -0,0 +1,37 @@
+"""
+logging configuration
+
+`LOG_LEVEL`で全体のレベル(既定INFO)、`LOG_LEVELS`でモジュールごとのレベルを指定する
+例: LOG_LEVELS=jma_common=DEBUG,jma_nowcast=WARNING
+"""
+
+import logging
+import os
+
+_level_env = 'LOG_LEVEL'
+_levels_env = 'LOG_LEVELS'
+_default_level = 'INFO'
+_format = '%(asctime)s %(levelname)s %(name)s %(message)s'
+
+def parse_levels(spec:str)->dict[str,str]:
+    """
+    parse `name=LEVEL,...` to dict
+    """
+    levels = dict()
+    for item in spec.split(','):
+        name, sep, level = item.partition('=')
+        if sep and name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def setup_logging(level:str|None=None, levels:dict[str,str]|None=None):
+    """
+    configure root logger and per-module levels from environment
+    """
+    if level is None:
+        level = os.environ.get(_level_env, _default_level)
+    if levels is None:
+        levels = parse_levels(os.environ.get(_levels_env, ''))
+    logging.basicConfig(level=level.upper(), format=_format)
+    for name, module_level in levels.items():
+        logging.getLogger(name).setLevel(module_level)
@@ -0,0 +1,128 @@
+"""
+bounded in-memory cache
+
+LRUで追い出し、ペイロードのバイト数で上限を管理する。エントリごとにTTLを持つ
+"""
+
+from collections import OrderedDict
+import os
+import sys
+import threading
+import time
+
+_max_bytes_env = 'JMA_MEM_CACHE_BYTES'
+_default_max_bytes = 64 * 1024 * 1024
+
+def payload_size(data:any)->int:
+    """
+    size of payload in bytes, decoded image counts its pixel buffer
+    """
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    if hasattr(data, 'getbands'): # PIL.Image
+        return image_size(data)
+    return sys.getsizeof(data)
+
+def image_size(img:any)->int:
+    """
+    size of decoded image in bytes
+    """
+    return img.width * img.height * len(img.getbands())
+
+class _lru_cache:
+    """
+    LRU cache class with byte budget and per-entry TTL, internal use only
+    """
+    def __init__(self, max_bytes:int=_default_max_bytes, size_func=payload_size):
+        self.max_bytes = max_bytes
+        self.size_func = size_func
+        self.entries = OrderedDict() # key -> (data, size, expires)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key:str, default:any=None)->any:
+        """
+        get data, `default` if missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            data, _, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def set(self, key:str, data:any, ttl:float|None=None):
+        """
+        add data, expires after `ttl` seconds (never if None)
+        """
+        size = self.size_func(data)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if size > self.max_bytes: # 単体で上限を超えるものは保持しない
+                return
+            expires = None if ttl is None else time.monotonic() + ttl
+            self.entries[key] = (data, size, expires)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def delete(self, key:str):
+        """
+        delete data
+        """
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        """
+        delete all data
+        """
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _remove(self, key:str):
+        _, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+
+    def __contains__(self, key:str)->bool:
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and (entry[2] is None or entry[2] > time.monotonic())
+
+    def __len__(self)->int:
+        return len(self.entries)
+
+    def stats(self)->dict:
+        """
+        counters and usage
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+def default_max_bytes()->int:
+    return int(os.environ.get(_max_bytes_env, _default_max_bytes))
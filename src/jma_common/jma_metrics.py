@@ -0,0 +1,181 @@
+"""
+fetch and pipeline metrics
+
+取得の待ち時間、受信バイト数、キャッシュのヒット、デコード時間、段階ごとの所要時間を集計する
+Prometheusのテキスト形式(node_exporterのtextfile collector向け)か、JSONで書き出す
+"""
+
+import contextlib
+import functools
+import inspect
+import json
+import os
+import tempfile
+import threading
+import time
+
+_textfile_env = 'JMA_METRICS_TEXTFILE'
+# 秒のヒストグラムの境界
+_default_buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _series(name:str, labels:dict)->str:
+    if not labels:
+        return name
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return name + '{' + ','.join(f'{_k}="{escape(_v)}"' for _k, _v in sorted(labels.items())) + '}'
+
+class _metrics:
+    """
+    metrics registry class, internal use only
+    """
+    def __init__(self, buckets:tuple=_default_buckets):
+        self.buckets = buckets
+        self.counters = dict() # (name, labels) -> value
+        self.histograms = dict() # (name, labels) -> [bucket counts..., count, sum, max]
+        self.helps = dict() # name -> help
+        self.collectors = [] # 書き出すときに値を集める関数
+        self.lock = threading.Lock()
+
+    def inc(self, name:str, value:float=1, help:str|None=None, **labels):
+        """
+        add `value` to counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            if help and name not in self.helps:
+                self.helps[name] = help
+
+    def observe(self, name:str, value:float, help:str|None=None, **labels):
+        """
+        add observation (seconds) to histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * len(self.buckets) + [0, 0.0, 0.0]
+                if help and name not in self.helps:
+                    self.helps[name] = help
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-3] += 1
+            hist[-2] += value
+            hist[-1] = max(hist[-1], value)
+
+    @contextlib.contextmanager
+    def timer(self, name:str, help:str|None=None, **labels):
+        """
+        observe elapsed time of block
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, help, **labels)
+
+    def register_collector(self, func):
+        """
+        register function returning [(name, type, help, labels, value), ...], called on export
+        """
+        self.collectors.append(func)
+
+    def collect(self)->list[tuple]:
+        """
+        all samples as [(name, type, help, labels, value), ...]
+        histogramのvalueは(bucket counts, count, sum, max)
+        """
+        with self.lock:
+            samples = [(_name, 'counter', self.helps.get(_name), dict(_labels), _value) for (_name, _labels), _value in self.counters.items()]
+            samples.extend(
+                (_name, 'histogram', self.helps.get(_name), dict(_labels), (tuple(_hist[:-3]), _hist[-3], _hist[-2], _hist[-1]))
+                for (_name, _labels), _hist in self.histograms.items()
+            )
+        for collector in self.collectors:
+            samples.extend(collector())
+        return samples
+
+    def snapshot(self)->dict:
+        """
+        samples as dict (for JSON), histogram as {count, sum, max}
+        """
+        result = dict()
+        for name, kind, _, labels, value in self.collect():
+            if kind == 'histogram':
+                _, count, total, peak = value
+                value = {'count': count, 'sum': round(total, 6), 'max': round(peak, 6)}
+            result[_series(name, labels)] = value
+        return result
+
+    def to_json(self)->str:
+        return json.dumps(self.snapshot())
+
+    def prometheus_text(self)->str:
+        """
+        samples in Prometheus text exposition format
+        """
+        by_name = dict()
+        for name, kind, help, labels, value in self.collect():
+            by_name.setdefault(name, (kind, help, []))[2].append((labels, value))
+        lines = []
+        for name, (kind, help, samples) in sorted(by_name.items()):
+            if help:
+                lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                if kind != 'histogram':
+                    lines.append(f'{_series(name, labels)} {value}')
+                    continue
+                counts, count, total, _ = value
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{_series(name + "_bucket", dict(labels, le=bound))} {bucket_count}')
+                lines.append(f'{_series(name + "_bucket", dict(labels, le="+Inf"))} {count}')
+                lines.append(f'{_series(name + "_sum", labels)} {total}')
+                lines.append(f'{_series(name + "_count", labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path:str|None=None):
+        """
+        write Prometheus textfile atomically, `JMA_METRICS_TEXTFILE` if `path` is omitted
+        """
+        path = path or os.environ.get(_textfile_env)
+        if not path:
+            return
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        # 書きかけを読まれないように、同じディレクトリの一時ファイルから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wt', encoding='utf-8') as tmpf:
+                tmpf.write(self.prometheus_text())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+metrics = _metrics()
+
+def timed(stage:str):
+    """
+    decorator observing duration of function as `jma_stage_seconds{stage=...}`
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper_async(*args, **kwargs):
+                with metrics.timer('jma_stage_seconds', 'duration of pipeline stage', stage=stage):
+                    return await func(*args, **kwargs)
+            return wrapper_async
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer('jma_stage_seconds', 'duration of pipeline stage', stage=stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,142 @@
+"""
+pooled HTTP sessions
+
+ホストごとにSessionを共有してkeep-aliveで接続を再利用し、リトライとバックオフを行う
+"""
+
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# (接続, 読み込み)のタイムアウト(秒)
+default_timeout: tuple[float,float] = (3.05, 10.0)
+default_retries: int = 2
+default_backoff_factor: float = 0.5
+backoff_max: float = 8.0
+retry_status: frozenset = frozenset({429, 500, 502, 503, 504})
+pool_maxsize: int = 8
+# ホストあたりの同時リクエスト数(スレッドから並列に呼ばれた場合の上限)
+max_requests_per_host: int = pool_maxsize
+# 指定した場合、全てのリクエストを`{origin_override}/{host}{path}`に向ける(記録したデータを返すローカルサーバ向け)
+origin_override: str|None = os.environ.get('JMA_ORIGIN_OVERRIDE') or None
+
+def _accept_encoding()->str:
+    # brがデコードできる場合のみ要求する(urllib3はbrotliがあれば自動で展開する)
+    for module_name in ['brotli', 'brotlicffi']:
+        try:
+            __import__(module_name)
+            return 'gzip, deflate, br'
+        except ImportError:
+            continue
+    return 'gzip, deflate'
+
+class _sessions:
+    """
+    session pool class, internal use only
+    """
+    def __init__(self):
+        self.sessions = dict()
+        self.host_limits = dict()
+        self.lock = threading.Lock()
+        self.accept_encoding = None
+
+    def get(self, url:str)->requests.Session:
+        """
+        get shared session for host of URL
+        """
+        host = urlsplit(url).netloc
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = self.create()
+                self.sessions[host] = session
+            return session
+
+    def limit(self, url:str)->threading.BoundedSemaphore:
+        """
+        get semaphore limiting concurrent requests to host of URL
+        """
+        host = urlsplit(url).netloc
+        with self.lock:
+            semaphore = self.host_limits.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(max_requests_per_host)
+                self.host_limits[host] = semaphore
+            return semaphore
+
+    def create(self)->requests.Session:
+        if self.accept_encoding is None:
+            self.accept_encoding = _accept_encoding()
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Accept-Encoding'] = self.accept_encoding
+        return session
+
+    def close(self):
+        """
+        close all sessions
+        """
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+sessions = _sessions()
+
+def rewrite_url(url:str)->str:
+    """
+    URL actually requested, rewritten to `origin_override` if set
+
+    キャッシュのキーやメトリクスには元のURLを使う
+    """
+    if not origin_override:
+        return url
+    parts = urlsplit(url)
+    return f'{origin_override.rstrip("/")}/{parts.netloc}{parts.path}' + (f'?{parts.query}' if parts.query else '')
+
+def _backoff_sleep(attempt:int, backoff_factor:float, resp:requests.Response|None=None):
+    wait = backoff_factor * (2 ** attempt)
+    if resp is not None:
+        retry_after = resp.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            wait = max(wait, int(retry_after))
+    time.sleep(min(backoff_max, wait))
+
+def request_get(url:str, timeout:float|tuple|None=None, retries:int|None=None, backoff_factor:float|None=None, **kwargs)->requests.Response:
+    """
+    GET using shared session, retry on connection error and 429/5xx with exponential backoff
+    """
+    return _request('GET', url, timeout, retries, backoff_factor, **kwargs)
+
+def request_head(url:str, timeout:float|tuple|None=None, retries:int|None=None, backoff_factor:float|None=None, **kwargs)->requests.Response:
+    """
+    HEAD using shared session, for checking existence without downloading body
+    """
+    return _request('HEAD', url, timeout, retries, backoff_factor, **kwargs)
+
+def _request(method:str, url:str, timeout:float|tuple|None, retries:int|None, backoff_factor:float|None, **kwargs)->requests.Response:
+    timeout = default_timeout if timeout is None else timeout
+    retries = default_retries if retries is None else retries
+    backoff_factor = default_backoff_factor if backoff_factor is None else backoff_factor
+    url = rewrite_url(url)
+    session = sessions.get(url)
+    limit = sessions.limit(url)
+    for attempt in range(retries + 1):
+        try:
+            with limit:
+                resp = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= retries:
+                raise
+            _backoff_sleep(attempt, backoff_factor)
+            continue
+        if resp.status_code not in retry_status or attempt >= retries:
+            return resp
+        resp.close()
+        _backoff_sleep(attempt, backoff_factor, resp)
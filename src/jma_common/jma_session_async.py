@@ -0,0 +1,134 @@
+"""
+pooled HTTP sessions for asyncio
+
+`jma_session`のasyncio版。イベントループごとにaiohttpのClientSessionを共有する
+"""
+
+import asyncio
+import atexit
+
+import aiohttp
+import requests
+
+from .jma_session import default_timeout, default_retries, default_backoff_factor, backoff_max, retry_status, rewrite_url
+
+# ホストあたりの同時接続数
+limit_per_host: int = 16
+
+class _async_response:
+    """
+    response read from aiohttp, same attributes as requests.Response used in `_cache.fetch`
+    """
+    def __init__(self, resp:aiohttp.ClientResponse, content:bytes):
+        self.request_info = resp.request_info
+        self.history = resp.history
+        self.url = str(resp.url)
+        self.status_code = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers
+        self.content = content
+        self.encoding = resp.charset
+
+    @property
+    def apparent_encoding(self)->str:
+        # 気象庁のデータはUTF-8
+        return 'utf-8'
+
+    @property
+    def text(self)->str:
+        return str(self.content, self.encoding or self.apparent_encoding, errors='replace')
+
+    def raise_for_status(self):
+        # 同期版と同じ例外にして、呼び出し側のエラー処理を一つにする
+        if self.status_code >= 400:
+            kind = 'Client' if self.status_code < 500 else 'Server'
+            raise requests.HTTPError(f'{self.status_code} {kind} Error: {self.reason} for url: {self.url}', response=self)
+
+class _async_sessions:
+    """
+    session pool class for asyncio, internal use only
+
+    イベントループが変わった場合(asyncio.runを繰り返した場合など)は、前のループのセッションを閉じてから作り直す
+    最後のセッションは終了時に閉じる
+    """
+    def __init__(self):
+        self.session = None
+        self.loop = None
+        self.atexit_registered = False
+
+    async def get(self)->aiohttp.ClientSession:
+        """
+        get shared session for running event loop
+        """
+        loop = asyncio.get_running_loop()
+        if self.session is not None and self.loop is not loop:
+            old, self.session = self.session, None
+            if not old.closed:
+                await old.close()
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=limit_per_host)
+            self.session = aiohttp.ClientSession(connector=connector)
+            self.loop = loop
+            if not self.atexit_registered:
+                atexit.register(self.close_at_exit)
+                self.atexit_registered = True
+        return self.session
+
+    async def close(self):
+        """
+        close session
+        """
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        self.loop = None
+
+    def close_at_exit(self):
+        if self.session is not None and not self.session.closed:
+            asyncio.run(self.close())
+
+async_sessions = _async_sessions()
+
+def _client_timeout(timeout:float|tuple)->aiohttp.ClientTimeout:
+    if isinstance(timeout, tuple):
+        return aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+    return aiohttp.ClientTimeout(total=timeout)
+
+async def request_get_async(url:str, timeout:float|tuple|None=None, retries:int|None=None, backoff_factor:float|None=None, **kwargs)->_async_response:
+    """
+    GET using shared session, retry on connection error and 429/5xx with exponential backoff
+    """
+    return await _request_async('GET', url, timeout, retries, backoff_factor, **kwargs)
+
+async def request_head_async(url:str, timeout:float|tuple|None=None, retries:int|None=None, backoff_factor:float|None=None, **kwargs)->_async_response:
+    """
+    HEAD using shared session, for checking existence without downloading body
+    """
+    return await _request_async('HEAD', url, timeout, retries, backoff_factor, **kwargs)
+
+async def _request_async(method:str, url:str, timeout:float|tuple|None, retries:int|None, backoff_factor:float|None, **kwargs)->_async_response:
+    timeout = _client_timeout(default_timeout if timeout is None else timeout)
+    retries = default_retries if retries is None else retries
+    backoff_factor = default_backoff_factor if backoff_factor is None else backoff_factor
+    url = rewrite_url(url)
+    session = await async_sessions.get()
+    for attempt in range(retries + 1):
+        try:
+            async with session.request(method, url, timeout=timeout, **kwargs) as resp:
+                if resp.status in retry_status and attempt < retries:
+                    retry_after = resp.headers.get('Retry-After', '')
+                else:
+                    content = await resp.read()
+                    return _async_response(resp, content)
+        except aiohttp.ClientConnectionError as e:
+            if attempt >= retries:
+                raise requests.ConnectionError(str(e)) from e
+            retry_after = ''
+        except asyncio.TimeoutError as e:
+            if attempt >= retries:
+                raise requests.Timeout(f'timeout: {url}') from e
+            retry_after = ''
+        wait = backoff_factor * (2 ** attempt)
+        if retry_after.isdigit():
+            wait = max(wait, int(retry_after))
+        await asyncio.sleep(min(backoff_max, wait))
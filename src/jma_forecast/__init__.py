@@ -2,4 +2,4 @@
 天気予報
 https://www.jma.go.jp/bosai/forecast/
 """
-from .jma_forecast import get_forecast_data_pretty
+from .jma_forecast import get_forecast_data_pretty, get_forecast_data_pretty_async, get_forecast_index, get_forecast_index_async
@@ -3,20 +3,34 @@
 https://www.jma.go.jp/bosai/forecast/
 """
 
-import copy
 from pprint import pprint
 import datetime
 import json
+import logging
 import os
-from jma_common import fetch_json, parse_dt_str, format_dt_str, get_area_cd_office_by_class10
+from jma_common import fetch_json, fetch_json_async, parse_dt_str, format_dt_str, get_area_cd_office_by_class10, get_area_cd_office_by_class10_async, timed
+
+logger = logging.getLogger(__name__)
 
 forecast_url_format : str = 'https://www.jma.go.jp/bosai/forecast/data/forecast/{area_cd_office}.json'
 
+def _weather_hass(label_ja: str) -> str:
+    # Home Assistantの天気の状態
+    if '雪' in label_ja and '雨' in label_ja:
+        return 'snowy-rainy'
+    elif '雪' in label_ja:
+        return 'snowy'
+    elif '雨' in label_ja:
+        return 'rainy'
+    elif '晴' == label_ja:
+        return 'sunny'
+    elif '曇' == label_ja:
+        return 'cloudy'
+    return 'partlycloudy'
+
 def _load_weather_codes():
-    module_path = os.path.abspath(__file__)
-    module_dir = os.path.dirname(module_path)
+    module_dir = os.path.dirname(os.path.abspath(__file__))
     json_path = os.path.join(module_dir, 'telops.json')
-    print(module_path, module_dir, json_path)
     with open(json_path, 'rt', encoding='utf-8') as jsonf:
         json_raw = json.load(jsonf)
     return {
@@ -26,10 +40,21 @@ def _load_weather_codes():
             'primary_weather': _v[2],
             'label_ja': _v[3],
             'label_en': _v[4],
+            'weather_hass': _weather_hass(_v[3]),
         } for _k, _v in json_raw.items()
     }
 
-_weather_codes = _load_weather_codes()
+# 天気コードの表。import時にファイルを読まないよう、初めて使うときに読み込み、Home Assistantの状態も合わせて求めておく
+_weather_codes : dict|None = None
+
+def get_weather_codes() -> dict:
+    """
+    天気コードごとのラベルとアイコン、Home Assistantの状態
+    """
+    global _weather_codes
+    if _weather_codes is None:
+        _weather_codes = _load_weather_codes()
+    return _weather_codes
 
 def get_forecast_url(area_cd_office: str) -> str:
     return forecast_url_format.format(
@@ -42,126 +67,185 @@ def get_forecast_data_raw(area_cd_office: str) -> dict:
     # pprint(data_raw)
     return data_raw
 
-def get_forecast_data_sub(area_cd_class10: str) -> dict:
-    area_code_office = get_area_cd_office_by_class10(area_cd_class10)
-    def sel(parent:dict):
-        _a = parent['areas']
-        del parent['areas']
-        parent['areas'] = _a[areaidx]
-
-    data_raw : dict = get_forecast_data_raw(area_code_office)
-    for _i, _a in enumerate(data_raw[0]['timeSeries'][0]['areas']):
-        if _a['area']['code']==area_cd_class10:
-            areaidx:int = _i
-            break
-    else:
-        raise ValueError(f'area sub code not found: {area_cd_class10}')
-    data_sel = copy.deepcopy(data_raw)
-    for _as in data_sel[0]['timeSeries']:
-        sel(_as)
-    #TODO 3日天気予報より7日天気予報のほうが予報地点が少ない。マッピング用のjsonがある？。week_area05.json
-    #むしろweek_area.jsonがすべて持ってるのでは。
-    for _as in data_sel[1]['timeSeries']:
-        sel(_as)
-    sel(data_sel[1]['precipAverage'])
-    sel(data_sel[1]['tempAverage'])
-    return data_sel
+async def get_forecast_data_raw_async(area_cd_office: str) -> dict:
+    url : str = get_forecast_url(area_cd_office)
+    return await fetch_json_async(url)
+
+# 府県予報区 -> [週間予報の区域]。3日予報の細分区域と同じ順に並ぶ
+week_area_url : str = 'https://www.jma.go.jp/bosai/forecast/const/week_area05.json'
+
+# 3日予報と週間予報で日ごとにまとめる要素
+_daily_keys = ['weatherCodes', 'pops', 'tempsMax', 'tempsMin']
+
+class _forecast_index:
+    """
+    office forecast index, internal use only
+
+    府県予報のJSONを一度だけ走査し、細分区域(class10)ごとの3日予報と、週間予報の区域ごとの系列を日付をキーにして持つ
+    """
+    def __init__(self, data_raw: list, week_area_codes: list|None = None):
+        self.report_times = tuple(_d.get('reportDatetime') for _d in data_raw)
+        self.day_keys = dict() # timeDefine -> 日付(0時)
+        self.areas3 = dict() # class10 -> {要素: {日付: 値}}
+        self.areas7 = dict() # 週間予報の区域 -> {要素: {日付: 値}}
+        self.index3(data_raw[0]['timeSeries'])
+        self.week_codes = self.index7(data_raw[1]['timeSeries']) if len(data_raw) > 1 else []
+        # week_area_codesは細分区域の順に並ぶ週間予報の区域
+        week_by_class10 = dict(zip(self.areas3, week_area_codes or []))
+        self.week_of = {_cd: self.resolve_week(_cd, week_by_class10) for _cd in self.areas3}
+        self.pretty_cache = dict()
+
+    def day_key(self, time_define: str) -> str:
+        key = self.day_keys.get(time_define)
+        if key is None:
+            key = format_dt_str(parse_dt_str(time_define).replace(hour=0,minute=0,second=0,microsecond=0))
+            self.day_keys[time_define] = key
+        return key
+
+    def index3(self, time_series: list):
+        # 天気と降水確率は細分区域ごと、気温はアメダス地点ごとで、地点は細分区域と同じ順に並ぶ
+        class10_codes = [_a['area']['code'] for _a in time_series[0]['areas']]
+        for _cd in class10_codes:
+            self.areas3[_cd] = {_k: dict() for _k in _daily_keys}
+        for _ts in time_series:
+            days = [self.day_key(_t) for _t in _ts['timeDefines']]
+            hours = [int(_t[11:13]) for _t in _ts['timeDefines']]
+            for _i, _a in enumerate(_ts['areas']):
+                cd = _a['area']['code'] if _a['area']['code'] in self.areas3 else (class10_codes[_i] if _i < len(class10_codes) else None)
+                if cd is None:
+                    continue
+                series = self.areas3[cd]
+                if 'weatherCodes' in _a:
+                    series['weatherCodes'].update(zip(days, _a['weatherCodes']))
+                if 'pops' in _a:
+                    for _d, _v in zip(days, _a['pops']):
+                        series['pops'].setdefault(_d, []).append(_v)
+                if 'temps' in _a:
+                    for _d, _h, _v in zip(days, hours, _a['temps']):
+                        if _h == 0:
+                            series['tempsMin'][_d] = _v
+                        elif _h == 9:
+                            series['tempsMax'][_d] = _v
+
+    def index7(self, time_series: list) -> list[str]:
+        # 天気と降水確率は週間予報の区域ごと、気温はアメダス地点ごとで、地点は区域と同じ順に並ぶ
+        week_codes = [_a['area']['code'] for _a in time_series[0]['areas']]
+        for _cd in week_codes:
+            self.areas7[_cd] = {_k: dict() for _k in _daily_keys}
+        for _ts in time_series:
+            days = _ts['timeDefines']
+            for _i, _a in enumerate(_ts['areas']):
+                cd = _a['area']['code'] if _a['area']['code'] in self.areas7 else (week_codes[_i] if _i < len(week_codes) else None)
+                if cd is None:
+                    continue
+                for _k in _daily_keys:
+                    if _k in _a:
+                        self.areas7[cd][_k].update(zip(days, _a[_k]))
+        return week_codes
+
+    def resolve_week(self, area_cd_class10: str, week_by_class10: dict) -> str|None:
+        """
+        細分区域に対応する週間予報の区域
+        週間予報の区域は細分区域より少ないことがあるので、同じコードがなければ対応表を使う
+        対応が決まらない場合は警告してNone(3日予報だけ)を返す
+        """
+        if not self.week_codes:
+            return None
+        if area_cd_class10 in self.areas7:
+            return area_cd_class10
+        mapped = week_by_class10.get(area_cd_class10)
+        if mapped in self.areas7:
+            return mapped
+        if len(self.week_codes) == 1:
+            return self.week_codes[0]
+        logger.warning('week area not found for %s (mapped: %s, week areas: %s)', area_cd_class10, mapped, ', '.join(self.week_codes))
+        return None
+
+    def pretty(self, area_cd_class10: str) -> dict:
+        """
+        日付ごとの天気、降水確率、最高・最低気温。3日予報がある日はそちらを優先する
+        """
+        if area_cd_class10 not in self.areas3:
+            raise ValueError(f'area sub code not found: {area_cd_class10}')
+        cached = self.pretty_cache.get(area_cd_class10)
+        if cached is None:
+            ret = dict()
+            for series in [self.areas7.get(self.week_of[area_cd_class10], {}), self.areas3[area_cd_class10]]:
+                for _k, _ts in series.items():
+                    for _t, _v in _ts.items():
+                        ret.setdefault(_t, dict())[_k] = _v
+            cached = { _t: _forecast_daily_norm(_v) for _t,_v in ret.items() }
+            self.pretty_cache[area_cd_class10] = cached
+        return cached
+
+_forecast_indexes : dict = dict() # office -> _forecast_index
 
+def _get_forecast_index(area_cd_office: str, data_raw: list, week_area_map: dict|None) -> _forecast_index:
+    # 発表時刻が変わっていなければ前回の索引を使う
+    index = _forecast_indexes.get(area_cd_office)
+    if index is None or index.report_times != tuple(_d.get('reportDatetime') for _d in data_raw):
+        week_area_codes = week_area_map.get(area_cd_office) if isinstance(week_area_map, dict) else None
+        if week_area_codes is not None and not isinstance(week_area_codes, list):
+            logger.warning('unexpected week area mapping for %s: %r', area_cd_office, week_area_codes)
+            week_area_codes = None
+        index = _forecast_index(data_raw, week_area_codes)
+        _forecast_indexes[area_cd_office] = index
+    return index
+
+def get_forecast_index(area_cd_office: str) -> _forecast_index:
+    """
+    府県予報区の予報の索引
+    """
+    data_raw = get_forecast_data_raw(area_cd_office)
+    week_area_map = fetch_json(week_area_url, cache_key='week_area', raise_error=False)
+    return _get_forecast_index(area_cd_office, data_raw, week_area_map)
+
+async def get_forecast_index_async(area_cd_office: str) -> _forecast_index:
+    data_raw = await get_forecast_data_raw_async(area_cd_office)
+    week_area_map = await fetch_json_async(week_area_url, cache_key='week_area', raise_error=False)
+    return _get_forecast_index(area_cd_office, data_raw, week_area_map)
+
+@timed('forecast')
 def get_forecast_data_pretty(area_cd_class10: str) -> dict:
-    data_sel : dict = get_forecast_data_sub(area_cd_class10)
-    # pprint(data_sel)
-    ts3:dict = dict()
-    ts7:dict = dict()
-    for _ts in data_sel[0]['timeSeries']:
-        for _n in ['waves','weatherCodes','weathers','winds','pops','temps']:
-            if _n in _ts['areas']:
-                ts3[_n] = { _k:_v for _k,_v in zip(_ts['timeDefines'],_ts['areas'][_n])}
-    for _ts in data_sel[1]['timeSeries']:
-        for _n in ['weatherCodes','pops','reliabilities','tempsMax','tempsMaxLower','tempsMaxUpper','tempsMin','tempsMinLower','tempsMinUpper']:
-            if _n in _ts['areas']:
-                ts7[_n] = { _k:_v for _k,_v in zip(_ts['timeDefines'],_ts['areas'][_n])}
-    ts3pops = dict()
-    for _t,_v in ts3['pops'].items():
-        _ts = format_dt_str(parse_dt_str(_t).replace(hour=0,minute=0,second=0,microsecond=0))
-        if _ts in ts3pops:
-            ts3pops[_ts].append(_v)
-        else:
-            ts3pops[_ts]=[_v]
-    ts3['pops'] = ts3pops
-    ts3['tempsMax']=dict()
-    ts3['tempsMin']=dict()
-    for _t,_v in ts3['temps'].items():
-        _tsdt = parse_dt_str(_t)
-        _ts = format_dt_str(_tsdt.replace(hour=0,minute=0,second=0,microsecond=0))
-        if _tsdt.hour == 0:
-            ts3['tempsMin'][_ts]=_v
-        elif _tsdt.hour == 9:
-            ts3['tempsMax'][_ts]=_v
-    del ts3['temps']
-    ts3['weatherCodes'] = {format_dt_str(parse_dt_str(_t).replace(hour=0,minute=0,second=0,microsecond=0)): _v for _t,_v in ts3['weatherCodes'].items()}
-
-    ret = dict()
-    for _k, _ts in ts7.items():
-        if _k not in ['weatherCodes', 'pops','tempsMax', 'tempsMin']:
-            continue
-        for _t, _v in _ts.items():
-            if _t not in ret:
-                ret[_t]=dict()
-            ret[_t][_k]=_v
-    for _k, _ts in ts3.items():
-        if _k not in ['weatherCodes', 'pops','tempsMax', 'tempsMin']:
-            continue
-        for _t, _v in _ts.items():
-            if _t not in ret:
-                ret[_t]=dict()
-            ret[_t][_k]=_v
-
-    def norm(_d: dict):
-        if "pops" in _d:
-            if isinstance(_d["pops"], list):
-                pops = max(map(int, _d["pops"]))
-            elif isinstance(_d["pops"],str):
-                pops = int(_d["pops"])
-            else:
-                pops = None
-        else:
-            pops = None
-        if "tempsMax" in _d:
-            temps_max = int(_d["tempsMax"])
-        else:
-            temps_max = None
-        if "tempsMin" in _d:
-            temps_min = int(_d["tempsMin"])
-        else:
-            temps_min = None
-        if "weatherCodes" in _d:
-            weather_code = _d["weatherCodes"]
-            weather_label = _weather_codes[weather_code]['label_ja']
-            if '雪' in weather_label and '雨' in weather_label:
-                weather_label_hass = 'snowy-rainy'
-            elif '雪' in weather_label:
-                weather_label_hass = 'snowy'
-            elif '雨' in weather_label:
-                weather_label_hass = 'rainy'
-            elif '晴' == weather_label:
-                weather_label_hass = 'sunny'
-            elif '曇' == weather_label:
-                weather_label_hass = 'cloudy'
-            else:
-                weather_label_hass = 'partlycloudy'
+    area_cd_office = get_area_cd_office_by_class10(area_cd_class10)
+    return get_forecast_index(area_cd_office).pretty(area_cd_class10)
+
+@timed('forecast')
+async def get_forecast_data_pretty_async(area_cd_class10: str) -> dict:
+    area_cd_office = await get_area_cd_office_by_class10_async(area_cd_class10)
+    return (await get_forecast_index_async(area_cd_office)).pretty(area_cd_class10)
+
+def _forecast_int(_v) -> int|None:
+    # 週間予報の初日などは空文字になる
+    return int(_v) if _v not in (None, '') else None
+
+def _forecast_daily_norm(_d: dict) -> dict:
+    if "pops" in _d:
+        if isinstance(_d["pops"], list):
+            pops = max((_x for _x in map(_forecast_int, _d["pops"]) if _x is not None), default=None)
         else:
-            weather_code = None
-            weather_label = None
-            weather_label_hass = None
-        return {
-            'pop': pops,
-            'temp_max': temps_max,
-            'temp_min': temps_min,
-            'weather_code': weather_code,
-            'weather': weather_label,
-            'weather_hass': weather_label_hass,
-        }
-    return { _t: norm(_v) for _t,_v in ret.items() }
+            pops = _forecast_int(_d["pops"])
+    else:
+        pops = None
+    temps_max = _forecast_int(_d.get("tempsMax"))
+    temps_min = _forecast_int(_d.get("tempsMin"))
+    if _d.get("weatherCodes"):
+        weather_code = _d["weatherCodes"]
+        weather_entry = get_weather_codes()[weather_code]
+        weather_label = weather_entry['label_ja']
+        weather_label_hass = weather_entry['weather_hass']
+    else:
+        weather_code = None
+        weather_label = None
+        weather_label_hass = None
+    return {
+        'pop': pops,
+        'temp_max': temps_max,
+        'temp_min': temps_min,
+        'weather_code': weather_code,
+        'weather': weather_label,
+        'weather_hass': weather_label_hass,
+    }
 
 if __name__ == '__main__':
     area_cd : str = '130010' # 東京-東京
@@ -2,4 +2,4 @@
 ナウキャスト
 https://www.jma.go.jp/bosai/nowc/
 """
-from .jma_nowcast import get_nowc_forecast, load_and_save_nowc_forecast_images
+from .jma_nowcast import get_nowc_forecast, get_nowc_forecast_async, get_nowc_forecast_points, get_nowc_forecast_points_async, get_nowc_forecast_area, get_nowc_forecast_area_async, load_and_save_nowc_forecast_images, get_nowc_animator, save_ani, encode_ani, ani_formats, prefetch_base_tiles
@@ -2,20 +2,41 @@
 ナウキャスト
 https://www.jma.go.jp/bosai/nowc/
 """
+from __future__ import annotations
+
 import os
 import math
+import functools
+import logging
 
-from typing import List, Tuple, Dict, Set, Any
-from pprint import pprint
+from typing import List, Tuple, Dict, Set, Any, TYPE_CHECKING
 from io import BytesIO
 import copy
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from jma_common import fetch_json, fetch_binary, fetch_image, fetch_json_async, fetch_image_async, metrics, timed
+
+from .jma_tile_store import base_tile_store
 
-from PIL import Image
+if TYPE_CHECKING:
+    # 注釈用。numpyとPILは使う関数の中で読み込む
+    import numpy as np
+    from PIL import Image
 
-from jma_common import fetch_json, fetch_binary
+logger = logging.getLogger(__name__)
 
 _DEBUG_STORE_IMG_=False
 
+# タイル取得の並列数。ホストあたりの上限はjma_common.jma_session.max_requests_per_hostで抑える
+tile_workers=int(os.environ.get('NOWCAST_TILE_WORKERS', '8'))
+# フレーム合成のプロセス数。0または1は合成を呼び出し元で順に行う
+compose_processes=int(os.environ.get('NOWCAST_COMPOSE_PROCESSES', '0'))
+# 保持するアニメーション描画器の数(地点と範囲ごと)。超えたら最も長く使っていないものを捨てる
+animators_max=int(os.environ.get('NOWCAST_ANIMATORS_MAX', '4'))
+
 
 # memo
 # L0   0mm 255,255,255,  0    0,  0,100 白（ただし透明） ←HSV　色相 彩度 明度
@@ -61,6 +82,18 @@ amount_by_level={
     8:(80,200),#200 は過去の日本最高記録(公式153非公式187)を想定した適当な値
 }
 
+@functools.cache
+def _level_lut() -> tuple:
+    """
+    色(RGBAを32bitにまとめた値)からレベルを引く表(キー, レベル)と、レベルから降水量(下限, 上限)を引く表
+    searchsortedで画像全体を一度に変換する。numpyは読み込みに時間がかかるので初回に読み込む
+    """
+    import numpy as np
+    keys = np.array(sorted((_r<<24)|(_g<<16)|(_b<<8)|_a for _r,_g,_b,_a in level_by_color), dtype=np.uint32)
+    values = np.array([level_by_color[((_k>>24)&0xff,(_k>>16)&0xff,(_k>>8)&0xff,_k&0xff)] for _k in keys.tolist()], dtype=np.uint8)
+    amount_lo = np.array([amount_by_level[_l][0] for _l in range(len(amount_by_level))], dtype=np.float64)
+    amount_hi = np.array([amount_by_level[_l][1] for _l in range(len(amount_by_level))], dtype=np.float64)
+    return keys, values, amount_lo, amount_hi
 
 def latlon_to_tile_pixel(lat, lon, lvl):
     lat_rad = math.radians(lat)
@@ -76,6 +109,20 @@ def latlon_to_tile_pixel(lat, lon, lvl):
     return tile_x, tile_y, pixel_x, pixel_y
 
 
+def latlon_to_tile_pixel_array(lats, lons, lvl):
+    """
+    latlon_to_tile_pixelの配列版。(tile_x, tile_y, pixel_x, pixel_y)の配列を返す
+    """
+    import numpy as np
+    lat_rad = np.radians(np.asarray(lats, dtype=np.float64))
+    n = 2 ** lvl
+    gx = (np.asarray(lons, dtype=np.float64) + 180.0) / 360.0 * n * 256
+    gy = (1.0 - np.log(np.tan(lat_rad) + 1 / np.cos(lat_rad)) / np.pi) / 2.0 * n * 256
+    gx = np.floor(gx).astype(np.int64)
+    gy = np.floor(gy).astype(np.int64)
+    return gx // 256, gy // 256, gx % 256, gy % 256
+
+
 def tile_pixel_to_latlon(tile_x, tile_y, pixel_x, pixel_y, lvl):
     n = 2 ** lvl
     gx = tile_x * 256 + pixel_x
@@ -95,44 +142,112 @@ def meters_per_pixel(lat, lvl):
     return (156543.03392 * math.cos(math.radians(lat))) / (2 ** lvl)
 
 def load_image_url(url):
-    binary:bytes = fetch_binary(url)
-    img_raw = Image.open(BytesIO(binary))
     # パレットモードのような挙動を示ことがある(getpixelの戻りが単一の数字になる)ので明示的にRGBAにコンバートする
-    img_cnv = img_raw.convert('RGBA')
-    return img_cnv
+    # 同じタイルは地点の予報とアニメーションで共有され、デコードは一度だけ
+    return fetch_image(url, mode='RGBA')
+
+async def load_image_url_async(url):
+    return await fetch_image_async(url, mode='RGBA')
+
+def get_base_image_url(lvl: int, tilex: int, tiley: int) -> str:
+    return f'https://www.jma.go.jp/tile/gsi/pale/{lvl}/{tilex}/{tiley}.png'
 
 def load_base_image_one(lvl: int, tilex: int, tiley: int) -> Image.Image:
-    url = f'https://www.jma.go.jp/tile/gsi/pale/{lvl}/{tilex}/{tiley}.png'
-    img = load_image_url(url)
+    if base_tile_store.enabled:
+        # 背景地図はほとんど変わらないので、保存済みならネットワークを使わない
+        binary = load_base_binary_one(lvl, tilex, tiley)
+        from PIL import Image
+        with metrics.timer('jma_decode_seconds', kind='image'):
+            img = Image.open(BytesIO(binary)).convert('RGBA')
+    else:
+        img = load_image_url(get_base_image_url(lvl, tilex, tiley))
     if _DEBUG_STORE_IMG_:
         img.save(f'./base_img_{lvl}_{tilex}_{tiley}.png')
     return img
 
-def load_base_image_join(lvl: int, lat:float, lon: float, radius_meter: int) -> Image.Image:
-    img = load_image_join(lvl, lat, lon, radius_meter, lambda lvl,x,y : load_base_image_one(lvl,x,y))
+def load_base_binary_one(lvl: int, tilex: int, tiley: int) -> bytes:
+    binary = base_tile_store.get(lvl, tilex, tiley)
+    if binary is None:
+        # タイルストアだけに保存する(ディスクキャッシュにも書くと同じタイルが2つ残る)
+        binary = fetch_binary(get_base_image_url(lvl, tilex, tiley), use_disk_cache=False)
+        base_tile_store.put(lvl, tilex, tiley, binary)
+    return binary
+
+def prefetch_base_tiles(lat1: float, lon1: float, lat2: float, lon2: float, zooms, workers: int|None=None) -> int:
+    """
+    範囲内の背景地図タイルをズームレベルごとにタイルストアに保存しておく。新たに取得したタイル数を返す
+    """
+    if not base_tile_store.enabled:
+        raise ValueError('タイルストアが指定されていません(NOWCAST_TILE_STORE または JMA_CACHE_DIR)')
+    jobs = []
+    for lvl in zooms:
+        tx1, ty1, _, _ = latlon_to_tile_pixel(max(lat1, lat2), min(lon1, lon2), lvl)
+        tx2, ty2, _, _ = latlon_to_tile_pixel(min(lat1, lat2), max(lon1, lon2), lvl)
+        jobs += [(lvl, _x, _y) for _x in range(tx1, tx2+1) for _y in range(ty1, ty2+1) if not base_tile_store.has(lvl, _x, _y)]
+    load_tiles(jobs, load_base_binary_one, workers)
+    return len(jobs)
+
+def load_base_image_join(lvl: int, lat:float, lon: float, radius_meter: int, workers: int|None=None) -> Image.Image:
+    img = load_image_join(lvl, lat, lon, radius_meter, load_base_image_one, workers)
     if _DEBUG_STORE_IMG_:
         img.save(f'./base_img_join_{lvl}.png')
     return img
 
+def get_rain_image_url(lvl: int, tilex: int, tiley: int, basetime: str, validtime: str) -> str:
+    return f'https://www.jma.go.jp/bosai/jmatile/data/nowc/{basetime}/none/{validtime}/surf/hrpns/{lvl}/{tilex}/{tiley}.png'
+
 def load_rain_image_one(lvl: int, tilex: int, tiley: int, basetime: str, validtime: str) -> Image.Image:
-    url=f'https://www.jma.go.jp/bosai/jmatile/data/nowc/{basetime}/none/{validtime}/surf/hrpns/{lvl}/{tilex}/{tiley}.png'
+    url=get_rain_image_url(lvl, tilex, tiley, basetime, validtime)
     img = load_image_url(url)
     if _DEBUG_STORE_IMG_:
         img.save(f'./rain_img_{lvl}_{tilex}_{tiley}_{basetime}_{validtime}.png')
-    return load_image_url(url)
+    return img
 
-def load_rain_image_join(lvl: int, lat:float, lon: float, radius_meter: int, basetime: str, validtime: str) -> Image.Image:
-    img = load_image_join(lvl, lat, lon, radius_meter, lambda lvl,x,y : load_rain_image_one(lvl,x,y,basetime,validtime))
+def load_rain_image_join(lvl: int, lat:float, lon: float, radius_meter: int, basetime: str, validtime: str, workers: int|None=None) -> Image.Image:
+    img = load_image_join(lvl, lat, lon, radius_meter, lambda lvl,x,y : load_rain_image_one(lvl,x,y,basetime,validtime), workers)
     if _DEBUG_STORE_IMG_:
         img.save(f'./rain_img_join_{lvl}_{basetime}_{validtime}.png')
     return img
 
-def get_rain_images_join_forecast(lat,lon,radius_meter,lvl=10):
+def get_rain_images_join_forecast(lat,lon,radius_meter,lvl=10,workers=None):
     nowc_times = get_nowc_forecast_times()
-    return [load_rain_image_join(lvl,lat,lon,radius_meter,_t['basetime'],_t['validtime']) for _t in nowc_times]
-
-def load_image_join(lvl: int, lat:float, lon: float, radius_meter: int, load_one_func) -> Image.Image:
-    print(lvl,lat,lon,radius_meter)
+    window = _tile_window(lvl, lat, lon, radius_meter)
+    return _load_rain_frames(lvl, window, nowc_times, workers)
+
+def _load_rain_frames(lvl, window, nowc_times, workers=None):
+    # 全時刻の全タイルをまとめて並列に取得し、時刻ごとに結合する
+    coords = _tile_coords(window)
+    jobs = [(lvl,_x,_y,_t['basetime'],_t['validtime']) for _t in nowc_times for _x,_y in coords]
+    tiles = load_tiles(jobs, load_rain_image_one, workers)
+    imgs = []
+    for _i, _t in enumerate(nowc_times):
+        img = _assemble_tiles(window, tiles[_i*len(coords):(_i+1)*len(coords)])
+        if _DEBUG_STORE_IMG_:
+            img.save(f'./rain_img_join_{lvl}_{_t["basetime"]}_{_t["validtime"]}.png')
+        imgs.append(img)
+    return imgs
+
+def load_tiles(jobs: list[tuple], load_one_func, workers: int|None=None) -> list[Image.Image]:
+    """
+    タイルを並列に読み込む。戻り値の順序はjobsと同じ
+    """
+    workers = tile_workers if workers is None else workers
+    if workers <= 1 or len(jobs) <= 1:
+        return [load_one_func(*_job) for _job in jobs]
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        return list(executor.map(lambda _job: load_one_func(*_job), jobs))
+
+def load_image_join(lvl: int, lat:float, lon: float, radius_meter: int, load_one_func, workers: int|None=None) -> Image.Image:
+    logger.debug('join tiles lvl=%s lat=%s lon=%s radius=%s', lvl, lat, lon, radius_meter)
+    window = _tile_window(lvl, lat, lon, radius_meter)
+    coords = _tile_coords(window)
+    tiles = load_tiles([(lvl,_x,_y) for _x,_y in coords], load_one_func, workers)
+    return _assemble_tiles(window, tiles)
+
+def _tile_window(lvl: int, lat:float, lon: float, radius_meter: int) -> tuple:
+    """
+    半径を含むタイルの範囲(tx1,ty1,tx2,ty2)と、結合画像からの切り出し範囲
+    """
     tx0,ty0,px0,py0 = latlon_to_tile_pixel(lat,lon,lvl)
     mpp = meters_per_pixel(lat,lvl)
     pxls = int(radius_meter / mpp)
@@ -144,17 +259,28 @@ def load_image_join(lvl: int, lat:float, lon: float, radius_meter: int, load_one
     ty1, py1 = divmod(gy1, 256)
     tx2, px2 = divmod(gx2, 256)
     ty2, py2 = divmod(gy2, 256)
-    img_join = Image.new("RGBA", ((tx2-tx1+1)*256,(ty2-ty1+1)*256))
-    for x in range(tx1, tx2+1):
-        for y in range(ty1, ty2+1):
-            img_one = load_one_func(lvl,x,y)
-            img_join.paste(img_one,((x-tx1)*256,(y-ty1)*256))
-    img_crop = img_join.crop((
+    crop = (
         px1,
         py1,
         (tx2-tx1)*256+px2,
         (ty2-ty1)*256+py2,
-    ))
+    )
+    return (tx1, ty1, tx2, ty2), crop
+
+def _tile_coords(window: tuple) -> list[tuple[int,int]]:
+    (tx1, ty1, tx2, ty2), _ = window
+    return [(x, y) for x in range(tx1, tx2+1) for y in range(ty1, ty2+1)]
+
+def _assemble_tiles(window: tuple, tiles: list[Image.Image]) -> Image.Image:
+    """
+    _tile_coordsの順に並んだタイルを結合して切り出す
+    切り出す範囲の画像だけを確保し、各タイルは範囲に重なる部分だけが貼られる(はみ出す部分はpasteが切り捨てる)
+    """
+    from PIL import Image
+    (tx1, ty1, tx2, ty2), (x1, y1, x2, y2) = window
+    img_crop = Image.new("RGBA", (x2-x1, y2-y1))
+    for (x, y), img_one in zip(_tile_coords(window), tiles):
+        img_crop.paste(img_one,((x-tx1)*256-x1,(y-ty1)*256-y1))
     return img_crop
 
 def get_rain_zoom(lvl):
@@ -173,18 +299,32 @@ def get_rain_zoom(lvl):
         raise ValueError('Zoomレベルは4から14の間で指定してください')
     return rain_lvl
 
+nowc_times_n1_url = 'https://www.jma.go.jp/bosai/jmatile/data/nowc/targetTimes_N1.json'
+nowc_times_n2_url = 'https://www.jma.go.jp/bosai/jmatile/data/nowc/targetTimes_N2.json'
+
 def get_nowc_forecast_times():
+    nowc_json1 = fetch_json(nowc_times_n1_url)
+    nowc_json2 = fetch_json(nowc_times_n2_url)
+    return _nowc_forecast_times(nowc_json1, nowc_json2)
+
+async def get_nowc_forecast_times_async():
+    nowc_json1, nowc_json2 = await asyncio.gather(
+        fetch_json_async(nowc_times_n1_url),
+        fetch_json_async(nowc_times_n2_url),
+    )
+    return _nowc_forecast_times(nowc_json1, nowc_json2)
+
+def _nowc_forecast_times(nowc_json1, nowc_json2):
     # N1 過去のタイムライン basetimeとvalidtimeは同じ elementsにhrpnsが含まれる(降雨ナウキャスト)
     # N2 basetimeはN1の最新と同じ(N2が更新が遅く1世代前のこともある)、validtimeがbasetimeの未来時刻で5分間隔で60分後まで(１２枚)
     # N3 elementsがその他諸々（雷とか）
-    nowc_json1 = fetch_json('https://www.jma.go.jp/bosai/jmatile/data/nowc/targetTimes_N1.json')
-    nowc_json2 = fetch_json('https://www.jma.go.jp/bosai/jmatile/data/nowc/targetTimes_N2.json')
     nowc_current = max(nowc_json1, key=lambda x: int(x['validtime']))
     nowc_times = copy.deepcopy(nowc_json2)
     nowc_times.append(nowc_current)
     nowc_times.sort(key=lambda x:(-int(x['basetime']),int(x['validtime'])))
     return nowc_times
 
+@timed('nowcast')
 def get_nowc_forecast(lat,lon,zoom=10):
     rain_zoom = get_rain_zoom(zoom)
 
@@ -192,21 +332,84 @@ def get_nowc_forecast(lat,lon,zoom=10):
 
     nowc_times = get_nowc_forecast_times()
 
-    colors=[]
+    rain_loads = load_tiles([(rain_zoom,rain_tile_x,rain_tile_y,_t['basetime'],_t['validtime']) for _t in nowc_times], load_rain_image_one)
     levels=[]
-    amounts=[]
-    for _t in nowc_times:
-        rain_load=load_rain_image_one(rain_zoom, rain_tile_x,rain_tile_y,_t['basetime'], _t['validtime'])
+    for _t, rain_load in zip(nowc_times, rain_loads):
         if _DEBUG_STORE_IMG_:
             rain_load.save(f'./rain_load_{_t["basetime"]}_{_t["validtime"]}_{rain_zoom}_{rain_tile_x}_{rain_tile_y}.png')
-        px=rain_load.getpixel((rain_pxl_x,rain_pxl_y,))
-        colors.append(px)
-        if px[3] == 0:
-            lvl = 0
-        else:
-            lvl = level_by_color[px]
-        levels.append(lvl)
-        amounts.append(amount_by_level[lvl])
+        levels.append(_rain_level_at(rain_load, rain_pxl_x, rain_pxl_y))
+    return _nowc_forecast_result(nowc_times, levels)
+
+@timed('nowcast')
+async def get_nowc_forecast_async(lat,lon,zoom=10):
+    rain_zoom = get_rain_zoom(zoom)
+
+    rain_tile_x, rain_tile_y, rain_pxl_x, rain_pxl_y = latlon_to_tile_pixel(lat, lon, rain_zoom)
+
+    nowc_times = await get_nowc_forecast_times_async()
+
+    rain_loads = await asyncio.gather(*[
+        load_image_url_async(get_rain_image_url(rain_zoom, rain_tile_x, rain_tile_y, _t['basetime'], _t['validtime']))
+        for _t in nowc_times
+    ])
+    levels = [_rain_level_at(_img, rain_pxl_x, rain_pxl_y) for _img in rain_loads]
+    return _nowc_forecast_result(nowc_times, levels)
+
+def _rain_level_at(rain_img, px, py):
+    color=rain_img.getpixel((px,py,))
+    if color[3] == 0:
+        return 0
+    return level_by_color[color]
+
+def _group_points_by_tile(lats, lons, lvl) -> dict:
+    """
+    地点をタイルごとにまとめる。{(tile_x, tile_y): (地点の番号, pixel_x, pixel_y)}
+    """
+    import numpy as np
+    tile_x, tile_y, pixel_x, pixel_y = latlon_to_tile_pixel_array(lats, lons, lvl)
+    tiles, inverse = np.unique(np.stack([tile_x, tile_y], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    groups = dict()
+    for _i, (_x, _y) in enumerate(tiles.tolist()):
+        idx = np.flatnonzero(inverse == _i)
+        groups[(_x, _y)] = (idx, pixel_x[idx], pixel_y[idx])
+    return groups
+
+def _nowc_forecast_points_result(nowc_times, groups, tiles, n_points):
+    """
+    タイルごとのレベルの配列から地点ごとの結果を作る。tilesは時刻ごとにgroupsの順
+    """
+    import numpy as np
+    levels = np.zeros((n_points, len(nowc_times)), dtype=np.uint8)
+    for _i in range(len(nowc_times)):
+        for (idx, pixel_x, pixel_y), img in zip(groups.values(), tiles[_i*len(groups):(_i+1)*len(groups)]):
+            levels[idx, _i] = rain_levels(img)[pixel_y, pixel_x]
+    return [_nowc_forecast_result(nowc_times, _l) for _l in levels.tolist()]
+
+def get_nowc_forecast_points(lats, lons, zoom=10, workers=None):
+    """
+    複数地点の降水ナウキャスト。地点ごとにget_nowc_forecastと同じ形式の結果を返す
+    時刻の一覧は一度だけ取得し、同じタイルにある地点はまとめて読む
+    """
+    rain_zoom = get_rain_zoom(zoom)
+    groups = _group_points_by_tile(lats, lons, rain_zoom)
+    nowc_times = get_nowc_forecast_times()
+    jobs = [(rain_zoom,_x,_y,_t['basetime'],_t['validtime']) for _t in nowc_times for _x,_y in groups]
+    tiles = load_tiles(jobs, load_rain_image_one, workers)
+    return _nowc_forecast_points_result(nowc_times, groups, tiles, len(lats))
+
+async def get_nowc_forecast_points_async(lats, lons, zoom=10):
+    rain_zoom = get_rain_zoom(zoom)
+    groups = _group_points_by_tile(lats, lons, rain_zoom)
+    nowc_times = await get_nowc_forecast_times_async()
+    tiles = await asyncio.gather(*[
+        load_image_url_async(get_rain_image_url(rain_zoom, _x, _y, _t['basetime'], _t['validtime']))
+        for _t in nowc_times for _x,_y in groups
+    ])
+    return _nowc_forecast_points_result(nowc_times, groups, tiles, len(lats))
+
+def _nowc_forecast_result(nowc_times, levels):
+    amounts=[amount_by_level[_lvl] for _lvl in levels]
     ret = [(
         _x[0]['validtime'],
         'observation' if _i==0 else 'forecast',
@@ -217,7 +420,92 @@ def get_nowc_forecast(lat,lon,zoom=10):
     ]
     return ret
 
+def rain_levels(rain_img: Image.Image) -> np.ndarray:
+    """
+    降水画像をレベルの配列(uint8, 高さx幅)に変換する
+    透明な画素と表にない色は0
+    """
+    import numpy as np
+    rgba = np.asarray(rain_img.convert('RGBA'), dtype=np.uint32)
+    codes = (rgba[...,0]<<24)|(rgba[...,1]<<16)|(rgba[...,2]<<8)|rgba[...,3]
+    lut_keys, lut_values, _, _ = _level_lut()
+    idx = np.minimum(np.searchsorted(lut_keys, codes), len(lut_keys)-1)
+    levels = np.where(lut_keys[idx] == codes, lut_values[idx], 0).astype(np.uint8)
+    levels[rgba[...,3] == 0] = 0
+    return levels
+
+def _levels_window(window: tuple, tiles: list[Image.Image]) -> np.ndarray:
+    """
+    _tile_coordsの順に並んだタイルをレベルの配列にして結合し、中心から半径の正方形を切り出す
+    """
+    import numpy as np
+    (tx1, ty1, tx2, ty2), (x1, y1, x2, y2) = window
+    # 切り出し範囲の右下は中心+半径の画素を含める
+    out = np.zeros((y2-y1+1, x2-x1+1), dtype=np.uint8)
+    for (x, y), img_one in zip(_tile_coords(window), tiles):
+        levels = rain_levels(img_one)
+        # タイルのうち切り出し範囲に重なる部分だけを写す
+        ox, oy = (x-tx1)*256-x1, (y-ty1)*256-y1
+        sx1, sy1 = max(0, -ox), max(0, -oy)
+        sx2, sy2 = min(levels.shape[1], out.shape[1]-ox), min(levels.shape[0], out.shape[0]-oy)
+        if sx1 < sx2 and sy1 < sy2:
+            out[oy+sy1:oy+sy2, ox+sx1:ox+sx2] = levels[sy1:sy2, sx1:sx2]
+    return out
+
+def _disk_mask(size: int) -> np.ndarray:
+    import numpy as np
+    r = (size - 1) / 2
+    yy, xx = np.ogrid[:size, :size]
+    return (yy - r) ** 2 + (xx - r) ** 2 <= r * r
+
+def _rain_stats(levels: np.ndarray) -> tuple:
+    """
+    円内の(最大レベル, 平均降水量の下限, 上限, 降水のある面積の割合)
+    """
+    import numpy as np
+    _, _, amount_lo, amount_hi = _level_lut()
+    area = levels[_disk_mask(levels.shape[0])]
+    return (
+        int(area.max()),
+        float(amount_lo[area].mean()),
+        float(amount_hi[area].mean()),
+        float(np.count_nonzero(area) / area.size),
+    )
+
+def get_nowc_forecast_area(lat, lon, radius_meter, zoom=10, workers=None):
+    """
+    地点から半径`radius_meter`の円内の降水を時刻ごとに集計する
+    戻り値は(validtime, 'observation'|'forecast', 最大レベル, 平均降水量の下限, 上限, 降水のある面積の割合)のリスト
+    """
+    rain_zoom = get_rain_zoom(zoom)
+    nowc_times = get_nowc_forecast_times()
+    window = _tile_window(rain_zoom, lat, lon, radius_meter)
+    coords = _tile_coords(window)
+    jobs = [(rain_zoom,_x,_y,_t['basetime'],_t['validtime']) for _t in nowc_times for _x,_y in coords]
+    tiles = load_tiles(jobs, load_rain_image_one, workers)
+    stats = [_rain_stats(_levels_window(window, tiles[_i*len(coords):(_i+1)*len(coords)])) for _i in range(len(nowc_times))]
+    return _nowc_area_result(nowc_times, stats)
+
+async def get_nowc_forecast_area_async(lat, lon, radius_meter, zoom=10):
+    rain_zoom = get_rain_zoom(zoom)
+    nowc_times = await get_nowc_forecast_times_async()
+    window = _tile_window(rain_zoom, lat, lon, radius_meter)
+    coords = _tile_coords(window)
+    tiles = await asyncio.gather(*[
+        load_image_url_async(get_rain_image_url(rain_zoom, _x, _y, _t['basetime'], _t['validtime']))
+        for _t in nowc_times for _x,_y in coords
+    ])
+    stats = [_rain_stats(_levels_window(window, tiles[_i*len(coords):(_i+1)*len(coords)])) for _i in range(len(nowc_times))]
+    return _nowc_area_result(nowc_times, stats)
+
+def _nowc_area_result(nowc_times, stats):
+    return [
+        (_t['validtime'], 'observation' if _i==0 else 'forecast', *_s)
+        for _i,(_t,_s) in enumerate(zip(nowc_times,stats))
+    ]
+
 def rain_composite(base_img, rain_img):
+    from PIL import Image
     resized_img = rain_img.resize((base_img.width, base_img.height), resample=Image.BOX)
     rain_composite = Image.composite(
         resized_img, base_img,
@@ -225,31 +513,194 @@ def rain_composite(base_img, rain_img):
     )
     return rain_composite
 
-def get_nowc_forecast_images(lat,lon,radius_meter,lvl=10):
+# プロセスプールの各ワーカーで共有する背景
+_worker_base_img = None
+
+def _compose_init(base_img):
+    global _worker_base_img
+    _worker_base_img = base_img
+
+def _compose_one(rain_img):
+    return rain_composite(_worker_base_img, rain_img)
+
+@timed('nowcast_compose')
+def compose_frames(base_img, rain_imgs, processes=None):
+    """
+    背景にフレームを合成する。`processes`(省略時は`compose_processes`)が2以上ならプロセスプールで並列に行う
+    背景はワーカーごとに一度だけ渡す。結果の順序と内容は逐次の場合と同じ
+    """
+    processes = compose_processes if processes is None else processes
+    if processes <= 1 or len(rain_imgs) <= 1:
+        return [rain_composite(base_img, _img) for _img in rain_imgs]
+    with ProcessPoolExecutor(max_workers=min(processes, len(rain_imgs)), initializer=_compose_init, initargs=(base_img,)) as executor:
+        return list(executor.map(_compose_one, rain_imgs))
+
+def get_nowc_forecast_images(lat,lon,radius_meter,lvl=10,workers=None):
     rain_lvl = get_rain_zoom(lvl)
-    base_img = load_base_image_join(lvl,lat,lon, radius_meter)
-    rain_imgs = get_rain_images_join_forecast(lat,lon, radius_meter, lvl=rain_lvl)
-    composite_imgs = [rain_composite(base_img, _img) for _img in rain_imgs]
+    base_img = load_base_image_join(lvl,lat,lon, radius_meter, workers=workers)
+    rain_imgs = get_rain_images_join_forecast(lat,lon, radius_meter, lvl=rain_lvl, workers=workers)
+    composite_imgs = compose_frames(base_img, rain_imgs)
     return composite_imgs
 
-def load_and_save_nowc_forecast_images(path, lat,lon,radius_meter,lvl=10, duration_base:int=2000, duration_rest:int=500, loop:int=0):
-    imgs = get_nowc_forecast_images(lat,lon,radius_meter,lvl)
-    save_ani_png(path,imgs,duration_base,duration_rest,loop)
-
-def save_ani_png(path:str, imgs:List[Image.Image], duration_base:int=2000, duration_rest:int=500, loop:int=0):
-    ani_base, ani_rest = imgs[0], imgs[1:]
-    ani_base.save(
+def load_and_save_nowc_forecast_images(path, lat,lon,radius_meter,lvl=10, duration_base:int=2000, duration_rest:int=500, loop:int=0, workers:int|None=None, fmt:str|None=None):
+    # Pillowのエンコーダは全フレームを揃えてから書き出すので、合成済みの一覧を渡す
+    imgs = get_nowc_forecast_images(lat,lon,radius_meter,lvl,workers=workers)
+    save_ani(path,imgs,fmt,duration_base,duration_rest,loop)
+
+class _nowc_animator:
+    """
+    incremental nowcast animation renderer, internal use only
+
+    背景地図を合成済みのフレームを(basetime, validtime)ごとに保持し、更新時は新しい時刻のフレームだけを取得・合成する
+    `past_frames`を指定すると、現在の前に過去の観測(N1)をその枚数だけ並べる
+    """
+    def __init__(self, lat:float, lon:float, radius_meter:int, lvl:int=10, past_frames:int=0, workers:int|None=None):
+        self.lat = lat
+        self.lon = lon
+        self.radius_meter = radius_meter
+        self.lvl = lvl
+        self.rain_lvl = get_rain_zoom(lvl)
+        self.past_frames = past_frames
+        self.workers = workers
+        self.window = _tile_window(self.rain_lvl, lat, lon, radius_meter)
+        self.base_img = None
+        self.frames = dict() # (basetime, validtime) -> 合成済みの画像
+        self.times = []
+        self.n_past = 0 # timesのうち過去の観測の枚数
+        self.lock = threading.Lock()
+
+    def timeline(self) -> tuple[list[dict], int]:
+        """
+        過去の観測、現在、予報の順の時刻と、そのうち過去の観測の枚数
+        N1にある過去の観測が`past_frames`より少なければ、あるだけ並べる
+        """
+        nowc_json1 = fetch_json(nowc_times_n1_url)
+        nowc_json2 = fetch_json(nowc_times_n2_url)
+        nowc_times = _nowc_forecast_times(nowc_json1, nowc_json2)
+        if self.past_frames <= 0:
+            return nowc_times, 0
+        current = int(nowc_times[0]['validtime'])
+        past = sorted((_t for _t in nowc_json1 if int(_t['validtime']) < current), key=lambda x:int(x['validtime']))
+        past = past[-self.past_frames:]
+        return past + nowc_times, len(past)
+
+    def update(self) -> list[Image.Image]:
+        """
+        最新の時刻に更新し、フレームを時刻順に返す
+        """
+        with self.lock:
+            if self.base_img is None:
+                self.base_img = load_base_image_join(self.lvl, self.lat, self.lon, self.radius_meter, workers=self.workers)
+            times, n_past = self.timeline()
+            keys = [(_t['basetime'], _t['validtime']) for _t in times]
+            new_times = [_t for _t, _k in zip(times, keys) if _k not in self.frames]
+            if new_times:
+                rain_imgs = _load_rain_frames(self.rain_lvl, self.window, new_times, self.workers)
+                for _t, _img in zip(new_times, compose_frames(self.base_img, rain_imgs)):
+                    self.frames[(_t['basetime'], _t['validtime'])] = _img
+            # 古い予報や窓から外れた観測は捨てる
+            self.frames = {_k: self.frames[_k] for _k in keys}
+            self.times = times
+            self.n_past = n_past
+            return [self.frames[_k] for _k in keys]
+
+    def current_index(self) -> int:
+        """
+        現在(最新の観測)のフレームの位置
+        """
+        return self.n_past
+
+    def save(self, path:str, duration_base:int=2000, duration_rest:int=500, loop:int=0, fmt:str|None=None):
+        """
+        更新してアニメーションを保存する。現在のフレームを`duration_base`ミリ秒表示する
+        """
+        imgs = self.update()
+        save_ani(path, imgs, fmt, duration_base, duration_rest, loop, base_index=self.current_index())
+
+_animators = OrderedDict()
+_animators_lock = threading.Lock()
+
+def get_nowc_animator(lat:float, lon:float, radius_meter:int, lvl:int=10, past_frames:int=0, workers:int|None=None) -> _nowc_animator:
+    """
+    地点と範囲ごとのアニメーションの描画器。同じ引数なら前回のフレームを引き継ぐ
+    保持するのは最近使った`animators_max`個まで
+    """
+    key = (lat, lon, radius_meter, lvl, past_frames)
+    with _animators_lock:
+        animator = _animators.get(key)
+        if animator is None:
+            animator = _animators[key] = _nowc_animator(lat, lon, radius_meter, lvl, past_frames, workers)
+            while len(_animators) > max(1, animators_max):
+                _animators.popitem(last=False)
+        _animators.move_to_end(key)
+        return animator
+
+def save_ani_png(path:str, imgs:List[Image.Image], duration_base:int=2000, duration_rest:int=500, loop:int=0, base_index:int=0):
+    save_ani(path, imgs, 'apng', duration_base, duration_rest, loop, base_index)
+
+# アニメーションの出力形式
+#   apng   RGBAのAPNG(従来の形式)
+#   apng-p 全フレームで共有するパレットに減色したAPNG
+#   webp   アニメーションWebP(可逆)
+#   gif    全フレームで共有するパレットに減色したGIF
+# いずれもPillowがフレーム間で変化した範囲だけを書き出す
+ani_formats = ['apng', 'apng-p', 'webp', 'gif']
+_ani_format_by_ext = {'.png': 'apng', '.apng': 'apng', '.webp': 'webp', '.gif': 'gif'}
+
+@timed('nowcast_save')
+def save_ani(path, imgs, fmt:str|None=None, duration_base:int=2000, duration_rest:int=500, loop:int=0, base_index:int=0):
+    """
+    アニメーションを保存する。`fmt`を省略した場合は拡張子から決める
+    `path`はファイル名またはファイルオブジェクト、`imgs`はフレームのリスト
+    """
+    if fmt is None:
+        fmt = _ani_format_by_ext.get(os.path.splitext(path)[1].lower(), 'apng') if isinstance(path, str) else 'apng'
+    durations = [duration_rest] * len(imgs)
+    durations[base_index] = duration_base
+    match fmt:
+        case 'apng':
+            frames = imgs
+            params = dict(format='PNG', disposal=0, blend=0, default_image=False)
+        case 'apng-p':
+            frames = _palettize(imgs)
+            params = dict(format='PNG', disposal=0, blend=0, default_image=False, optimize=True)
+        case 'webp':
+            frames = imgs
+            params = dict(format='WEBP', lossless=True, method=4, quality=50)
+        case 'gif':
+            frames = _palettize(imgs)
+            params = dict(format='GIF', disposal=1, optimize=False)
+        case _:
+            raise ValueError(f'invalid animation format: {fmt}')
+    frames[0].save(
         path,
-        format='PNG',
         save_all = True,
-        append_images = ani_rest,
-        duration = [duration_base, *([duration_rest]*len(ani_rest))],
+        append_images = frames[1:],
+        duration = durations,
         loop = loop,
-        disposal = 0,
-        blend = 0,
-        default_image = False,
+        **params,
     )
 
+def encode_ani(imgs:List[Image.Image], fmt:str='apng', duration_base:int=2000, duration_rest:int=500, loop:int=0, base_index:int=0) -> bytes:
+    """
+    アニメーションをバイト列にする
+    """
+    buf = BytesIO()
+    save_ani(buf, imgs, fmt, duration_base, duration_rest, loop, base_index)
+    return buf.getvalue()
+
+def _palettize(imgs:List[Image.Image], colors:int=256) -> List[Image.Image]:
+    """
+    全フレームを縦に並べて一度だけ減色し、そのパレットを全フレームで共有する
+    降水の色は固定の少数なので、背景地図と合わせても256色に収まりやすい
+    """
+    from PIL import Image
+    width, height = imgs[0].size
+    strip = Image.new('RGB', (width, height*len(imgs)))
+    for _i, _img in enumerate(imgs):
+        strip.paste(_img.convert('RGB'), (0, height*_i))
+    palette = strip.quantize(colors, method=Image.Quantize.MEDIANCUT)
+    return [_img.convert('RGB').quantize(palette=palette, dither=Image.Dither.NONE) for _img in imgs]
 
 if __name__ == '__main__':
     import dotenv
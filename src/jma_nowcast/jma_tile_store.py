@@ -0,0 +1,89 @@
+"""
+persistent tile store
+
+地理院タイル(背景地図)のように、ほとんど変わらないタイルをSQLiteに保存する
+テーブル構成はMBTilesと同じ(tile_rowはTMS、つまり南から数える)
+"""
+
+import os
+import sqlite3
+import threading
+
+_store_path_env = 'NOWCAST_TILE_STORE'
+_cache_dir_env = 'JMA_CACHE_DIR'
+
+class _tile_store:
+    """
+    tile store class, internal use only
+    """
+    def __init__(self, path:str|None = None):
+        self.path = path
+        self.conn = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self)->bool:
+        return bool(self.path)
+
+    def connect(self)->sqlite3.Connection:
+        # fork後は親プロセスの接続を使わない
+        if self.conn is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS metadata (name text, value text)')
+            conn.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+            conn.commit()
+            self.conn = conn
+            self.pid = os.getpid()
+        return self.conn
+
+    def get(self, lvl:int, tilex:int, tiley:int)->bytes|None:
+        """
+        get stored tile, None if missing
+        """
+        with self.lock:
+            row = self.connect().execute(
+                'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                (lvl, tilex, _tms_row(lvl, tiley)),
+            ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def has(self, lvl:int, tilex:int, tiley:int)->bool:
+        with self.lock:
+            row = self.connect().execute(
+                'SELECT 1 FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                (lvl, tilex, _tms_row(lvl, tiley)),
+            ).fetchone()
+        return row is not None
+
+    def put(self, lvl:int, tilex:int, tiley:int, data:bytes):
+        """
+        store tile
+        """
+        with self.lock:
+            conn = self.connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)',
+                (lvl, tilex, _tms_row(lvl, tiley), sqlite3.Binary(data)),
+            )
+            conn.commit()
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None and self.pid == os.getpid():
+                self.conn.close()
+            self.conn = None
+
+def _tms_row(lvl:int, tiley:int)->int:
+    return (2 ** lvl) - 1 - tiley
+
+def _default_store_path()->str|None:
+    path = os.environ.get(_store_path_env)
+    if path:
+        return path
+    cache_dir = os.environ.get(_cache_dir_env)
+    return os.path.join(cache_dir, 'gsi_pale.mbtiles') if cache_dir else None
+
+base_tile_store = _tile_store(_default_store_path())
@@ -2,4 +2,4 @@
 地域時系列予報
 https://www.jma.go.jp/bosai/wdist/timeseries.html
 """
-from .jma_vpfd import get_vpfd_data_pretty
+from .jma_vpfd import get_vpfd_data_pretty, get_vpfd_data_pretty_async
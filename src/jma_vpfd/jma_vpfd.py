@@ -2,9 +2,11 @@
 地域時系列予報
 https://www.jma.go.jp/bosai/wdist/timeseries.html
 """
-from pprint import pprint
 import datetime
-from jma_common import fetch_text, fetch_json, parse_dt_str
+import logging
+from jma_common import fetch_text, fetch_json, fetch_json_async, parse_dt_str, timed
+
+logger = logging.getLogger(__name__)
 
 vpfd_url_format : str = 'https://www.jma.go.jp/bosai/jmatile/data/wdist/VPFD/{area_cd}.json'
 
@@ -16,18 +18,31 @@ def get_vpfd_url(area_cd: str) -> str:
 def get_vpfd_data_raw(area_cd: str) -> dict:
     url : str = get_vpfd_url(area_cd)
     data_raw : dict = fetch_json(url)
-    pprint(data_raw)
+    logger.debug('vpfd raw %s', data_raw) # 文字列化は出力するときだけ
     return data_raw
 
+async def get_vpfd_data_raw_async(area_cd: str) -> dict:
+    url : str = get_vpfd_url(area_cd)
+    return await fetch_json_async(url)
+
+@timed('vpfd')
 def get_vpfd_data_pretty(area_cd: str) -> dict:
     data_raw : dict = get_vpfd_data_raw(area_cd)
+    return _vpfd_data_pretty(data_raw)
+
+@timed('vpfd')
+async def get_vpfd_data_pretty_async(area_cd: str) -> dict:
+    data_raw : dict = await get_vpfd_data_raw_async(area_cd)
+    return _vpfd_data_pretty(data_raw)
+
+def _vpfd_data_pretty(data_raw: dict) -> dict:
     area_time_series = {
         _t['dateTime']: {
             'weather': data_raw['areaTimeSeries']['weather'][_i],
             'wind': data_raw['areaTimeSeries']['wind'][_i],
         } for _i,_t in enumerate(data_raw['areaTimeSeries']['timeDefines'])
     }
-    pprint(area_time_series)
+    logger.debug('area time series %s', area_time_series)
     point_time_series = {
         _t['dateTime']: {
             'maxTemperature': data_raw['pointTimeSeries']['maxTemperature'][_i],
@@ -35,7 +50,7 @@ def get_vpfd_data_pretty(area_cd: str) -> dict:
             'temperature': data_raw['pointTimeSeries']['temperature'][_i],
         } for _i,_t in enumerate(data_raw['pointTimeSeries']['timeDefines'])
     }
-    pprint(point_time_series)
+    logger.debug('point time series %s', point_time_series)
     time_series = [
         {
             'datetime': _timestr,
@@ -46,7 +61,7 @@ def get_vpfd_data_pretty(area_cd: str) -> dict:
             'temperature': point_time_series[_timestr]['temperature'],
         } for _timestr in sorted(area_time_series.keys())
     ]
-    pprint(time_series)
+    logger.debug('time series %s', time_series)
     return [
         {
             'datetime': _x['datetime'],
@@ -62,6 +77,7 @@ def get_vpfd_data_pretty(area_cd: str) -> dict:
     ]
     
 if __name__ == '__main__':
+    from pprint import pprint
     area_cd : str = '130010' # 東京-東京
     data_j : dict = get_vpfd_data_pretty(area_cd)
     pprint(data_j)
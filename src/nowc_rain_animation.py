@@ -1,9 +1,22 @@
 import os
-from jma_nowcast import load_and_save_nowc_forecast_images
+import time
+from jma_nowcast import get_nowc_animator
 
 map_lat=float(os.environ['NOWCAST_RAIN_LAT'])
 map_lon=float(os.environ['NOWCAST_RAIN_LON'])
 map_zoom=int(os.environ['NOWCAST_RAIN_ZOOM'])
 map_range=int(os.environ['NOWCAST_RAIN_RADAR_RANGE'])
+# apng, apng-p, webp, gif
+map_format=os.environ.get('NOWCAST_RAIN_FORMAT', 'apng')
+map_ext={'webp': '.webp', 'gif': '.gif'}.get(map_format, '.png')
+# 現在の前に並べる過去の観測の枚数
+map_past_frames=int(os.environ.get('NOWCAST_RAIN_PAST_FRAMES', '0'))
+# 指定した場合は常駐して、この間隔(秒)で新しい時刻のフレームだけを取得・合成して保存し直す
+map_interval=int(os.environ.get('NOWCAST_RAIN_INTERVAL', '0'))
 
-load_and_save_nowc_forecast_images('./animated.png',map_lat,map_lon,map_range,lvl=map_zoom)
+animator = get_nowc_animator(map_lat,map_lon,map_range,lvl=map_zoom,past_frames=map_past_frames)
+while True:
+    animator.save(f'./animated{map_ext}',fmt=map_format)
+    if map_interval <= 0:
+        break
+    time.sleep(map_interval)